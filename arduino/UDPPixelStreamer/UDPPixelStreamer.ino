@@ -31,12 +31,23 @@
 #define NUM_LEDS 60
 #define DATA_PIN 6
 
+// chunked framing, for strips too long for one packet: each packet is 0xDF, frame number,
+// first pixel, pixel count (FRAGMENT in holidayshows/utils/udp_strip.py), then r, g, b for those pixels
+#define FRAGMENT_HEADER 7
+#define FRAGMENT_PIXELS 480  // pixels in every fragment but the last, MAX_PAYLOAD / 3 in udp_strip.py
+#define FRAGMENTS ((NUM_LEDS + FRAGMENT_PIXELS - 1) / FRAGMENT_PIXELS)
+#if FRAGMENTS > 31
+#error "too many fragments to track for NUM_LEDS"
+#endif
+
 char packetBuffer[NUM_LEDS*3];
 CRGB leds[NUM_LEDS];
 
 EthernetUDP Udp;
 
 uint16_t msg_counter = 0;
+uint16_t fragment_frame = 0;
+uint32_t fragments_arrived = 0;  // a bit for each fragment of fragment_frame
 // Local mac address, initialiser can be removed (when using initMacAddress)
 uint8_t mac[6] = {0x00,0x01,0x02,0x03,0x04,0x05};
 
@@ -163,12 +174,47 @@ void setup() {
   Udp.begin(2700);
 }
 
+void readFragment(int packetSize) {
+  // the pixels go straight into leds, and the frame is shown once all of its fragments have arrived
+  uint8_t header[FRAGMENT_HEADER];
+  Udp.read(header, FRAGMENT_HEADER);
+  uint16_t frame = (header[1] << 8) | header[2];
+  uint16_t offset = (header[3] << 8) | header[4];
+  uint16_t count = (header[5] << 8) | header[6];
+  if (offset % FRAGMENT_PIXELS || offset + count > NUM_LEDS || packetSize != FRAGMENT_HEADER + count * 3) {
+    #ifdef SERIAL_DEBUG
+      Serial.print("Unexpected Fragment: ");
+      Serial.print(offset);
+      Serial.print(" ");
+      Serial.println(count);
+    #endif
+    return;
+  }
+  if (frame != fragment_frame) {
+    // whatever is missing of the last frame is never shown
+    fragment_frame = frame;
+    fragments_arrived = 0;
+  }
+  Udp.read((uint8_t*)&leds[offset], count * 3);
+  fragments_arrived |= 1UL << (offset / FRAGMENT_PIXELS);
+  if (fragments_arrived == (1UL << FRAGMENTS) - 1) {
+    #ifdef SERIAL_DEBUG
+      Serial.println("Showing Strip");
+    #endif
+    msg_counter++;
+    FastLED.show();
+    fragments_arrived = 0;
+  }
+}
+
 void loop() {
   Ethernet.maintain();
   
   int packetSize = Udp.parsePacket();
   char re[3] = {0x00, 0x00, 0x00};
-  if (packetSize > 0) {
+  if (packetSize > FRAGMENT_HEADER && packetSize != NUM_LEDS*3 && Udp.peek() == 0xDF) {
+      readFragment(packetSize);
+  } else if (packetSize > 0) {
       Udp.read(packetBuffer, NUM_LEDS*3);
       if (packetSize == 3){
         switch ((uint8_t)packetBuffer[0]) {
@@ -11,7 +11,7 @@ import sys
 import time
 import traceback
 
-from holidayshows.utils import calendar_entry, home, remote_server, relay_server, sun
+from holidayshows.utils import calendar_entry, home, metrics, remote_server, relay_server, sun
 
 class Holiday_Pixels(object):
     def __init__(self):
@@ -25,6 +25,9 @@ class Holiday_Pixels(object):
             config = self.load_config()
             self.process_config(config)
             self.init_home()
+            metrics.register(self.home.metrics)
+            metrics.register(metrics.collect_image_cache)
+            self.serve_metrics(metrics.CONTROLLER_PORT)
             try:
                 if self.args.demo:
                     self.demo(self.args.demo)
@@ -34,14 +37,20 @@ class Holiday_Pixels(object):
                 pass
             finally:
                 print('cleaning up')
-                self.home.cleanup()
+                self.home.close()
 
     def run_pixel_server(self):
+        self.serve_metrics(metrics.REMOTE_PORT)
         remote_server.run_remote()
 
     def run_relay_server(self):
+        self.serve_metrics(metrics.RELAY_PORT)
         relay_server.RelayServer()
 
+    def serve_metrics(self, default_port):
+        port = default_port if self.args.metrics_port is None else self.args.metrics_port
+        metrics.serve(port)
+
     def init_home(self):
         self.home = home.Home(self.globals)
             
@@ -153,23 +162,50 @@ class Holiday_Pixels(object):
         return ret
 
     def process_relay_remotes(self, remotes):
-        return {name: {'name': name, 'invert': remote.get('invert', False), 'host': remote['host'], 'relays': remote['relays']} for name, remote in remotes.items()}
+        return {name: {'name': name, 'invert': remote.get('invert', False), 'keepalive': remote.get('keepalive'), 'host': remote['host'], 'relays': remote['relays']} for name, remote in remotes.items()}
 
     def process_strips(self, strips):
         processed_strips = []
         for name, strip in strips.items():
-            processed_strips.append({
+            processed_strip = {
                 'name': name,
-                'pin': strip['pin'],
+                'backend': strip.get('backend', 'ws281x'),
                 'pixel_order': strip['pixel_order'],
-                'frequency': strip['frequency'],
-                'dma': strip['dma'],
-                'invert': strip['invert'],
-                'pin_channel': strip['pin_channel'],
-                'brightness': strip['brightness'],
                 'length': strip['length'],
-                'black': strip.get('black', [])
-            })
+                'black': strip.get('black', []),
+                'image_cache': strip.get('image_cache'),
+                'streaming': strip.get('streaming', False),
+                'stream_directory': strip.get('stream_directory'),
+                'live_port': strip.get('live_port', 2702),
+                'remote': strip.get('remote', name)
+            }
+            if processed_strip['backend'] == 'udp':
+                processed_strip.update({
+                    'frequency': strip.get('frequency', 800000),
+                    'nodes': [{
+                        'host': node['host'],
+                        'port': node.get('port', 2700),
+                        'pixels': node['pixels'],
+                        'framing': node.get('framing', 'raw')
+                    } for node in strip['nodes']],
+                    'packet_gap': strip.get('packet_gap', 0)
+                })
+            elif processed_strip['backend'] == 'recording':
+                processed_strip.update({
+                    'frequency': strip.get('frequency', 800000),
+                    'frames': strip.get('frames', 1024),
+                    'simulate': strip.get('simulate', True)
+                })
+            else:
+                processed_strip.update({
+                    'pin': strip['pin'],
+                    'frequency': strip['frequency'],
+                    'dma': strip['dma'],
+                    'invert': strip['invert'],
+                    'pin_channel': strip['pin_channel'],
+                    'brightness': strip['brightness']
+                })
+            processed_strips.append(processed_strip)
         return processed_strips
 
     def process_strip(self, strip):
@@ -245,6 +281,7 @@ class Holiday_Pixels(object):
         parser.add_argument('--settings', help="JSON style settings dictionary of temporary overrides")
         parser.add_argument('--remote', action='store_true', help="Run a remote pixel server. All other options are ignored.")
         parser.add_argument('--relays', action='store_true', help="Run a relay box server. All other options are ignored.")
+        parser.add_argument('--metrics-port', type=int, help=f"Port to serve Prometheus metrics on. Defaults to {metrics.CONTROLLER_PORT}, or {metrics.REMOTE_PORT} with --remote and {metrics.RELAY_PORT} with --relays. 0 to turn off")
         self.args = parser.parse_args()
         print(self.args)
 
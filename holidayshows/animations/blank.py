@@ -30,3 +30,4 @@ class Animation(object):
             i += 1
             if not (i % 100):
                 self.home.report_dropped_frames()
+                self.home.heartbeat()
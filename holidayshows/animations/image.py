@@ -1,14 +1,73 @@
 #!/usr/bin/env python3
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import datetime
 import os
 import random
 import time
+import traceback
 
 from PIL import Image
 import numpy as np
 
-from ..utils import progress_bar, players, image_slicer
+from ..utils import progress_bar, players, image_slicer, metrics, remote_client, scheduler
+
+LEAD_SECONDS = 2  # from sending a song's plays until it starts, for them to reach every remote
+
+class Preloader(object):
+    '''
+    loads the song after the one playing, and unloads each song once it has played, so the
+    remotes hold two songs at a time rather than the whole playlist. with keep, songs stay
+    loaded once they are. loads and unloads take turns on one thread, since they share
+    each remote's loading session
+    '''
+    def __init__(self, animation, keep=False):
+        self.animation = animation
+        self.keep = keep
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='preload')
+        self.loading = {}  # (resource, future), by song index
+        self.loaded = {}  # resources, by song index
+
+    def preload(self, resource):
+        index = resource['index']
+        if index not in self.loaded and index not in self.loading:
+            self.loading[index] = resource, self.executor.submit(self.animation.run_loads, resource)
+
+    def ready(self, resource):
+        '''
+        waits for the song to finish loading, starting it now if it wasn't preloaded.
+        returns False if it couldn't be loaded
+        '''
+        index = resource['index']
+        self.preload(resource)
+        if index in self.loading:
+            _, future = self.loading.pop(index)
+            try:
+                future.result()
+            except Exception:
+                traceback.print_exc()
+                print(f'skipping {resource["name"]}, which did not load')
+                self.executor.submit(self.animation.unload, resource)  # whatever did load
+                return False
+            self.loaded[index] = resource
+        return True
+
+    def release(self, resource):
+        if not self.keep and self.loaded.pop(resource['index'], None) is not None:
+            self.executor.submit(self.animation.unload, resource)
+
+    def close(self):
+        '''
+        waits for loads still running, and unloads everything
+        '''
+        self.executor.shutdown(wait=True)
+        for resource, future in self.loading.values():
+            self.animation.unload(resource)  # even a failed load may have loaded some of it
+        for resource in self.loaded.values():
+            self.animation.unload(resource)
+        self.loading.clear()
+        self.loaded.clear()
 
 class Animation(object):
     def __init__(self, home, globals_, settings):
@@ -21,6 +80,10 @@ class Animation(object):
         return 'Image'
     
     def load_resources(self):
+        '''
+        works out what every song needs loaded on each remote. the loads run when the
+        song is about to play, or all of them now with "preload": "all"
+        '''
         self.resources_loaded = []
         self.resources_without_sound = []
 
@@ -44,43 +107,82 @@ class Animation(object):
                 path = path.format(random.randint(1, self.settings['variations']))
 
             resource['data'] = {}
+            resource['loads'] = defaultdict(list)
 
             for key, options in element['slices'].items():
                 if key == 'relays':
                     continue
-                self.loading_times['remote metadata'] -= time.time()
                 start = options['start']
                 end = options['end']
                 wrap = options.get('wrap', False)
-                self.loading_times['remote metadata'] += time.time()
                 # slice = self.slice_image(image_data, start, end, wrap)
                 # self.slicer.slice_image(path, start, end, wrap)
                 # resource['data'][key] = slice
-                self.loading_times['remote transfer'] -= time.time()
-                self.home.remote_clients[key].load_data(players.PLAYER_KINDS.STRIP, {'index': index, 'slice_data': [path, start, end, wrap]})
+                self.queue_load(resource, self.home.strip_clients[key], 'slice', players.PLAYER_KINDS.STRIP, {'index': index, 'strip': key, 'slice_data': [path, start, end, wrap]})
                 # self.home.remote_clients[key].load_data(players.PLAYER_KINDS.STRIP, {'index': index, 'image_data': slice})
-                self.loading_times['remote transfer'] += time.time()
 
             if 'relays' in element['slices']:
                 options = element['slices']['relays']
                 if procedural := self.parse_procedural_relays(options):
-                    self.home.local_client.load_data(players.PLAYER_KINDS.STRIP, {'index': index, 'procedural_relays': procedural, 'relay_order': resource['relays'], 'home': self.home})
+                    self.queue_load(resource, self.home.local_client, 'relays', players.PLAYER_KINDS.STRIP, {'index': index, 'procedural_relays': procedural, 'relay_order': resource['relays'], 'home': self.home})
                 else:
                     start = options['start']
                     end = options['end']
                     if end == 'auto':
                         end = len(resource['relays'])
-                    self.home.local_client.load_data(players.PLAYER_KINDS.STRIP, {'index': index, 'relay_slice': [path, start, end], 'relay_order': resource['relays'], 'home': self.home})
+                    self.queue_load(resource, self.home.local_client, 'relays', players.PLAYER_KINDS.STRIP, {'index': index, 'relay_slice': [path, start, end], 'relay_order': resource['relays'], 'home': self.home})
 
-            self.loading_times['music'] -= time.time()
             music = element.get('music')
             if music:
-                self.home.music_client.load_data(players.PLAYER_KINDS.MUSIC, {'index': index, 'music': music})
+                self.queue_load(resource, self.home.music_client, 'music', players.PLAYER_KINDS.MUSIC, {'index': index, 'music': music})
                 resource['sound'] = True
                 self.resources_loaded.append(resource)
             else:
                 self.resources_without_sound.append(resource)
-            self.loading_times['music'] += time.time()
+
+    def queue_load(self, resource, client, category, kind, data):
+        resource['loads'][client.name].append((category, kind, data))
+
+    def run_loads(self, resource):
+        '''
+        each remote works through the song's loads in order, while all remotes load at the same time
+        '''
+        loads = resource['loads']
+        with ThreadPoolExecutor(max_workers=max(len(loads), 1)) as executor:
+            futures = {executor.submit(self.load_remote, name, resource['index'], remote_loads): name for name, remote_loads in loads.items()}
+            for future in as_completed(futures):
+                name = futures[future]
+                seconds, category_seconds = future.result()
+                print(f'{name} finished loading {resource["name"]} in {seconds:.04f} seconds')
+                for category, category_time in category_seconds.items():
+                    self.loading_times[f'{name} {category}'] += category_time
+
+    def load_remote(self, name, index, loads):
+        '''
+        loads over a session of its own, so it can run while the remote plays, then checks
+        the remote has the song. returns the seconds it took, and the seconds spent on each
+        category of load
+        '''
+        start = time.time()
+        client = self.home.remote_clients[name].loading_session()
+        category_seconds = defaultdict(float)
+        for category, kind, data in loads:
+            load_start = time.time()
+            client.load_data(kind, data)
+            category_seconds[category] += time.time() - load_start
+        for category, seconds in category_seconds.items():
+            metrics.set_value('holidayshows_song_load_seconds', seconds, remote=name, category=category)
+        loaded = client.status()['loaded']
+        for kind in set(kind for category, kind, data in loads):
+            if index not in loaded.get(kind.name.lower(), []):
+                raise ValueError(f'{name} does not have song {index} after loading it')
+        return time.time() - start, category_seconds
+
+    def unload(self, resource):
+        for name, loads in resource['loads'].items():
+            client = self.home.remote_clients[name].loading_session()
+            for kind in set(kind for category, kind, data in loads):
+                client.unload(kind, resource['index'])
 
     @staticmethod
     def parse_procedural_relays(options):
@@ -100,18 +202,36 @@ class Animation(object):
 
     def main(self, end_by):
         self.repeat = self.settings.get('repeat', 1)
+        self.gap = self.settings.get('gap', 3)
+        self.lead = self.settings.get('lead', LEAD_SECONDS)
+        preload = self.settings.get('preload', 'next')
+        if preload not in ('next', 'all'):
+            raise ValueError(f'preload `{preload}` should be "next" or "all"')
 
         start = time.time()
-        from collections import defaultdict
-        self.loading_times = defaultdict(float)
+        self.loading_times = defaultdict(float)  # totals, by remote and category, over every song loaded
         self.load_resources()
-        print(time.time() - start, 'seconds to load resources')
+        self.preloader = Preloader(self, keep=preload == 'all')
+        try:
+            if preload == 'all':
+                for resource in self.resources_without_sound + self.resources_loaded:
+                    self.preloader.ready(resource)
+                print(time.time() - start, 'seconds to load resources')
+                self.print_loading_times()
+            else:
+                print('each song loads while the one before it plays')
+            # time.sleep(30)
+            self.run_shows(end_by)
+        finally:
+            self.preloader.close()
+
+    def print_loading_times(self):
         loading_times = list(self.loading_times.items())
         loading_times.sort(key=lambda x:x[1])
         for key, value in loading_times:
-            print(f'{key:<20s} took {value:.04f} seonds')
-        # time.sleep(30)
+            print(f'{key:<20s} took {value:.04f} seconds')
 
+    def run_shows(self, end_by):
         if self.settings.get('days'):
             days = set(self.settings['days'])
         else:
@@ -137,38 +257,62 @@ class Animation(object):
                     print('LAST SHOW ENDED. silent animation until night time:', end_by)
                     self.home.report_dropped_frames()
                     self.activate_relays(show_starting=False, any_show_tonight=False)
-                    self.present(silent_resource, end_by)
+                    self.present_loaded(silent_resource, end_by)
                     return
                 else:
+                    self.order_playlist()
                     print('silent animation until', until)
                     self.activate_relays(show_starting=False, any_show_tonight=True)
-                    self.present(silent_resource, until-datetime.timedelta(seconds=5))
+                    following = self.resources_loaded[0] if self.resources_loaded else None
+                    self.present_loaded(silent_resource, until-datetime.timedelta(seconds=5), following=following)
             else:
                 print('silent animation until night time:', end_by)
                 self.home.report_dropped_frames()
                 self.activate_relays(show_starting=False, any_show_tonight=False)
-                self.present(silent_resource, end_by)
+                self.present_loaded(silent_resource, end_by)
                 return
             
             self.activate_relays(show_starting=True, any_show_tonight=True)  # before a music show
-            order = self.settings.get('order')
-            if order == 'shuffle':
-                random.shuffle(self.resources_loaded)
-            elif isinstance(order, list):
-                if len(order):
-                    def keyer(resource):
-                        if resource['name'] in order:
-                            return order.index(resource['name'])
-                        else:
-                            return max(order)+1  # put it at the end, in the original order
-                    self.resources_loaded.sort(key=keyer)
-            else:
-                assert order is None
-            for resource in self.resources_loaded:
-                self.present(resource, end_by, epoch=until.timestamp())
-                time.sleep(3)
+            playlist = self.resources_loaded
+            previous_end = None
+            for position, resource in enumerate(playlist):
+                following = playlist[position + 1] if position + 1 < len(playlist) else None
+                # the gap runs from the end of the song before, rather than being added to the lead
+                start_at = None if previous_end is None else previous_end + self.gap
+                self.present_loaded(resource, end_by, epoch=until.timestamp(), following=following, start_at=start_at)
+                previous_end = time.time()
+            self.print_loading_times()
             time.sleep(10)
 
+    def order_playlist(self):
+        order = self.settings.get('order')
+        if order == 'shuffle':
+            random.shuffle(self.resources_loaded)
+        elif isinstance(order, list):
+            if len(order):
+                def keyer(resource):
+                    if resource['name'] in order:
+                        return order.index(resource['name'])
+                    else:
+                        return max(order)+1  # put it at the end, in the original order
+                self.resources_loaded.sort(key=keyer)
+        else:
+            assert order is None
+
+    def present_loaded(self, resource, end_by, epoch=None, following=None, start_at=None):
+        '''
+        presents the song once it has loaded, loading the following one while it plays,
+        and unloads it afterwards
+        '''
+        if not self.preloader.ready(resource):
+            return
+        if following is not None:
+            self.preloader.preload(following)
+        try:
+            self.present(resource, end_by, epoch, start_at)
+        finally:
+            self.preloader.release(resource)
+
     def activate_relays(self, show_starting, any_show_tonight):
         relay_group_values = {
             'off_when_blank': True,
@@ -189,7 +333,10 @@ class Animation(object):
             return image_slice[:,:,0] > 127
         raise ValueError('Relay pixels must be black or white')
 
-    def present(self, resource, end_by, epoch=None):
+    def present(self, resource, end_by, epoch=None, start_at=None):
+        '''
+        plays the song once the lead has passed, or at start_at if that is later
+        '''
         end_by_float = end_by.timestamp()
         self.home.show_relays()
 
@@ -209,20 +356,17 @@ class Animation(object):
             else:
                 print('not early. late by', early, 'seconds')
         else:
-            epoch = time.time() + 2
-            players = []
+            # synchronizing first leaves the lead only the plays to send
+            self.home.remote_clients.synchronize_stale()
+            epoch = time.time() + self.lead
+            if start_at is not None:
+                epoch = max(epoch, start_at)
+            schedule = scheduler.Scheduler()
             for remote in self.home.remote_clients.values():
-                players.append(remote.play(resource['index'], repeat, end_by_float, epoch, resource['fps']))
-            while True:
-                still_going = False
-                for player in players:
-                    try:
-                        message = next(player)
-                        # print('\r', str(message).ljust(50), end='')
-                        still_going = True
-                    except StopIteration:
-                        pass
-                if not still_going:
-                    break
+                schedule.add(remote.play(resource['index'], repeat, end_by_float, epoch, resource['fps']))
+            # once the plays are sent
+            schedule.add(self.home.remote_clients.keep_alive(), time.time() + remote_client.FINISHED_POLL_SECONDS)
+            schedule.run()
+            self.home.report_frame_timing()
 
         print('image complete')
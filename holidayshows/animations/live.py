@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import time
+
+import numpy as np
+
+from ..utils import remote_client, scheduler
+
+class Animation(object):
+    '''
+    rows made as the show runs and streamed to every strip, with nothing loaded ahead of time.
+    settings: "fps" (default 30), and "speed", in trips along the strip per second (default 0.1)
+    '''
+    def __init__(self, home, globals_, settings):
+        self.home = home
+        self.globals = globals_
+        self.settings = settings
+
+    def __str__(self):
+        return 'Live'
+
+    def main(self, end_by):
+        end_by_float = end_by.timestamp()
+        fps = self.settings.get('fps', 30)
+        sender = self.home.live_sender()
+        schedule = scheduler.Scheduler()
+        for client in self.home.clients_with_strips():
+            schedule.add(client.play_live(end_by_float, fps))
+        schedule.add(self.render(sender, end_by_float, fps))
+        schedule.add(self.home.remote_clients.keep_alive(), time.time() + remote_client.FINISHED_POLL_SECONDS)
+        schedule.run()
+        self.home.report_frame_timing()
+
+    def render(self, sender, end_by, fps):
+        '''
+        sends one row to each strip every frame, stamped to be shown sender.latency later
+        '''
+        speed = self.settings.get('speed', 0.1)
+        lengths = {strip_config['name']: strip_config['length'] for strip_config in self.globals['strips']}
+        start = time.time()
+        frame = 0
+        while True:
+            now = start + frame / fps
+            show_at = now + sender.latency
+            if show_at >= end_by:
+                return
+            for name, length in lengths.items():
+                sender.send(name, self.rainbow(length, (show_at - start) * speed), show_at)
+            frame += 1
+            yield start + frame / fps
+
+    @staticmethod
+    def rainbow(length, offset):
+        hue = (np.arange(length) / length + offset) % 1 * 6
+        # distance from each of red, green and blue on the color wheel
+        distance = np.abs((hue[:, None] - np.array([0, 2, 4])) % 6 - 3)
+        return (np.clip(distance - 1, 0, 1) * 255).astype(np.uint8)
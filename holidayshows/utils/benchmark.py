@@ -0,0 +1,253 @@
+'''
+benchmarks the frame loop: Strip_Player.play, driven through Players.play_all by a
+scheduler, drawing to a recording strip and sending relay states to a local socket.
+
+    python3 -m holidayshows.utils.benchmark [--lengths 360 450] [--compare old.json]
+
+runs every combination of the given strip lengths, fps, black range counts, fade and
+relay modes, prints a table and saves the results as JSON. with --compare, each case
+is shown next to the same case from an earlier run
+'''
+
+import argparse
+import contextlib
+from datetime import datetime
+import io
+import itertools
+import json
+import platform
+import socket
+import time
+import tracemalloc
+
+import numpy as np
+
+from . import players, relay, scheduler
+
+RELAYS = 16
+RELAYS_PER_REMOTE = 8
+BLACK_WIDTH = 4
+
+class Bench_Remote(relay.RelayRemote):
+    '''
+    a relay box that is really a socket on this computer that never reads
+    '''
+    sink = None
+
+    def handshake(self):
+        if Bench_Remote.sink is None:
+            Bench_Remote.sink = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            Bench_Remote.sink.bind(('127.0.0.1', 0))
+        if not hasattr(relay.RelayRemote, '_socket'):
+            relay.RelayRemote._socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.ip, self.port = Bench_Remote.sink.getsockname()
+
+    def get_frames(self):
+        sent_count = self.counter
+        self.counter = 0
+        return sent_count, sent_count
+
+class Bench_Home(object):
+    def __init__(self):
+        self.relays = {}
+        self.remotes = {}
+        names = [f'relay {i}' for i in range(RELAYS)]
+        for i in range(0, RELAYS, RELAYS_PER_REMOTE):
+            name = f'bench {i // RELAYS_PER_REMOTE}'
+            remote = Bench_Remote(name, {'host': '127.0.0.1', 'relays': names[i:i + RELAYS_PER_REMOTE]})
+            self.remotes[name] = remote
+            self.relays.update(remote)
+
+    def show_relays(self, do_print=False):
+        for remote in self.remotes.values():
+            remote.show()
+
+    def report_dropped_frames(self):
+        pass
+
+    def report_relay_duty_cycles(self):
+        pass
+
+def measured(generator, clock, samples):
+    '''
+    passes a player's deadlines through, timing the CPU the player used to get each
+    one and how late it was resumed
+    '''
+    while True:
+        start = time.thread_time()
+        try:
+            deadline = next(generator)
+        except StopIteration:
+            return
+        samples['cpu'] += time.thread_time() - start
+        yield deadline
+        if deadline is not None:
+            samples['lateness'].append(clock() - deadline)
+
+def black_ranges(length, count):
+    '''
+    count ranges of BLACK_WIDTH pixels, spread evenly along the strip
+    '''
+    spacing = length // (count + 1)
+    return [[spacing * (i + 1), spacing * (i + 1) + BLACK_WIDTH] for i in range(count)]
+
+def relay_rows(height, fps, rng):
+    '''
+    each relay flips about twice a second
+    '''
+    flips = rng.random((height, RELAYS)) < 2 / fps
+    return np.logical_xor.accumulate(flips, axis=0)
+
+class Case(object):
+    def __init__(self, length, fps, blacks, fade, relays, duration, seed=0):
+        self.params = {'length': length, 'fps': fps, 'blacks': blacks, 'fade': fade, 'relays': relays}
+        self.duration = duration
+        self.fps = fps
+        self.rng = np.random.default_rng(seed)
+        self.home = Bench_Home()
+        self.height = int(fps * duration)
+        self.players = players.Players()
+        self.players.add(players.PLAYER_KINDS.STRIP, {
+            'backend': 'recording',
+            'frequency': 800000,
+            'length': length,
+            'black': black_ranges(length, blacks),
+            'pixel_order': 'GRB',
+            'frames': self.height + 2,
+        })
+        self.strip_player = self.players[players.PLAYER_KINDS.STRIP]
+        image_data = self.rng.integers(0, 256, (self.height, length, 3), dtype=np.uint8)
+        self.load({'image_data': image_data})
+        relay_order = list(self.home.relays)
+        if relays == 'timeline':
+            self.load({'relay_data': relay_rows(self.height, fps, self.rng), 'relay_order': relay_order, 'home': self.home})
+        elif relays == 'cycle':
+            self.load({'procedural_relays': {'mode': 'cycle', 'timing': 1}, 'relay_order': relay_order, 'home': self.home})
+        elif relays == 'random':
+            self.load({'procedural_relays': {'mode': 'random', 'timing': 2, 'duty_cycle': 0.5}, 'relay_order': relay_order, 'home': self.home})
+        elif relays != 'none':
+            raise ValueError(f'unknown relay mode `{relays}`')
+
+    def load(self, data):
+        data['index'] = 0
+        self.players.load_data(players.PLAYER_KINDS.STRIP, data)
+
+    def arguments(self, duration):
+        epoch = time.time() + 0.05
+        if self.params['fade']:
+            # fading only happens when looping until end_by
+            return {'index': 0, 'repeat': 0, 'end_by': epoch + duration, 'epoch': epoch, 'fps': self.fps}
+        return {'index': 0, 'repeat': 1, 'end_by': epoch + duration, 'epoch': epoch, 'fps': self.fps}
+
+    def run(self):
+        samples = {'cpu': 0.0, 'lateness': []}
+        arguments = self.arguments(self.duration)
+        # play_all calls the player's play, so the deadlines are timed as the player yields them
+        play = self.strip_player.play
+        self.strip_player.play = lambda arguments: measured(play(arguments), time.time, samples)
+        schedule = scheduler.Scheduler()
+        schedule.add(self.players.play_all(arguments))
+        real_strip = self.strip_player.strip.strips['strip'].real_strip
+        real_strip.begin()
+        start = time.thread_time()
+        try:
+            schedule.run()
+        finally:
+            del self.strip_player.play
+        total_cpu = time.thread_time() - start
+        frames, times = real_strip.recorded()
+        shown = len(times) - 1  # the last one is cleanup clearing the strip
+        elapsed = times[shown - 1] - times[0] if shown > 1 else 0
+        lateness = np.array(samples['lateness']) * 1000
+        result = dict(self.params)
+        result.update({
+            'frames': shown,
+            'target_fps': self.fps,
+            'achieved_fps': (shown - 1) / elapsed if elapsed else 0.0,
+            'cpu_ms_per_frame': samples['cpu'] * 1000 / shown if shown else 0.0,
+            # includes the scheduler, and its spinning before each deadline
+            'total_cpu_ms_per_frame': total_cpu * 1000 / shown if shown else 0.0,
+            'lateness_ms': {f'p{p}': float(np.percentile(lateness, p)) if len(lateness) else 0.0 for p in (50, 90, 99, 100)},
+        })
+        result['allocations'] = self.allocations()
+        return result
+
+    def allocations(self):
+        '''
+        peak memory allocated while playing, and what was still allocated after, in KiB.
+        tracemalloc slows everything down, so this is played again separately from the timing
+        '''
+        arguments = self.arguments(self.duration)
+        schedule = scheduler.Scheduler()
+        schedule.add(self.players.play_all(arguments))
+        tracemalloc.start()
+        try:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            schedule.run()
+            after, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return {'peak_kib': (peak - before) / 1024, 'retained_kib': (after - before) / 1024}
+
+    def close(self):
+        self.strip_player.stop()
+
+def key(result):
+    return tuple(result[name] for name in ('length', 'fps', 'blacks', 'fade', 'relays'))
+
+def print_result(result, previous=None):
+    params = f'{result["length"]:>5d} px {result["fps"]:>3d} fps {result["blacks"]:>2d} blacks {"fade" if result["fade"] else "    "} {result["relays"]:<8s}'
+    lateness = result['lateness_ms']
+    line = (f'{params} {result["achieved_fps"]:6.1f} fps cpu/frame {result["cpu_ms_per_frame"]:6.3f} ms ({result["total_cpu_ms_per_frame"]:6.3f} total) '
+            f'late p50 {lateness["p50"]:6.2f} p99 {lateness["p99"]:6.2f} max {lateness["p100"]:6.2f} ms '
+            f'peak {result["allocations"]["peak_kib"]:8.1f} KiB')
+    if previous is not None:
+        fps_change = result['achieved_fps'] - previous['achieved_fps']
+        cpu_change = result['cpu_ms_per_frame'] / previous['cpu_ms_per_frame'] - 1 if previous['cpu_ms_per_frame'] else 0
+        line += f' | {fps_change:+.1f} fps, cpu {cpu_change:+.0%}'
+    print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Frame loop benchmark')
+    parser.add_argument('--lengths', nargs='+', type=int, default=[360, 450, 1000, 3000], help='Strip lengths in pixels')
+    parser.add_argument('--fps', nargs='+', type=int, default=[40], help='Frames per second to ask for')
+    parser.add_argument('--blacks', nargs='+', type=int, default=[0, 8], help='Numbers of black ranges')
+    parser.add_argument('--fade', nargs='+', choices=['off', 'on'], default=['off', 'on'], help='Play once, or loop with fading')
+    parser.add_argument('--relays', nargs='+', choices=['none', 'timeline', 'cycle', 'random'], default=['none', 'timeline', 'cycle', 'random'], help='Relay modes')
+    parser.add_argument('--duration', type=float, default=2, help='Seconds to play each case')
+    parser.add_argument('--output', default=f'benchmark-{datetime.now():%Y%m%d-%H%M%S}.json', help='Where to save the results')
+    parser.add_argument('--compare', help='Results from an earlier run to compare against')
+    parser.add_argument('--verbose', action='store_true', help='Show what the players print')
+    args = parser.parse_args()
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {key(result): result for result in json.load(f)['results']}
+
+    results = []
+    for length, fps, blacks, fade, relays in itertools.product(args.lengths, args.fps, args.blacks, args.fade, args.relays):
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with output:
+            case = Case(length, fps, blacks, fade == 'on', relays, args.duration)
+            try:
+                result = case.run()
+            finally:
+                case.close()
+        results.append(result)
+        print_result(result, previous.get(key(result)))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'time': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'duration': args.duration,
+            'results': results,
+        }, f, indent=1)
+    print('saved results to', args.output)
+
+if __name__ == '__main__':
+    main()
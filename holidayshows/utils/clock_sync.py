@@ -0,0 +1,98 @@
+from collections import deque
+import time
+
+from . import metrics
+
+SAMPLES = 8  # round trips per synchronization
+HISTORY = 16  # synchronizations kept for estimating drift
+MIN_DRIFT_SPAN = 60  # seconds of history needed before trusting a drift estimate
+RESYNC_SECONDS = 600
+
+metrics.describe('holidayshows_clock_offset_seconds', 'gauge', 'Remote clock minus master clock, at the last synchronization')
+metrics.describe('holidayshows_clock_drift_ppm', 'gauge', 'Estimated drift of the remote clock against the master')
+metrics.describe('holidayshows_clock_sync_age_seconds', 'gauge', 'Time since the last synchronization')
+
+def best_sample(samples):
+    '''
+    samples are (master send time, master receive time, remote time) round trips.
+    the one with the shortest round trip has the least room for error,
+    and the remote time is assumed to be read halfway through it
+    returns master time, offset (remote - master), and round trip time
+    '''
+    sent, received, remote_time = min(samples, key=lambda sample: sample[1] - sample[0])
+    midpoint = (sent + received) / 2
+    return midpoint, remote_time - midpoint, received - sent
+
+class Clock_Sync:
+    '''
+    offset and drift of a remote clock relative to the master clock
+    remote time = master time + offset + drift * (master time - reference)
+    '''
+    def __init__(self):
+        self.history = deque(maxlen=HISTORY)
+        self.offset = 0.0
+        self.drift = 0.0
+        self.reference = 0.0
+        self.last_sync = 0.0
+
+    def update(self, master_time, offset):
+        self.history.append((master_time, offset))
+        self.offset = offset
+        self.reference = master_time
+        self.last_sync = time.time()
+        self.drift = self.estimate_drift()
+
+    def estimate_drift(self):
+        '''
+        least squares slope of offset over time
+        '''
+        if len(self.history) < 2:
+            return 0.0
+        times = [sample[0] for sample in self.history]
+        if times[-1] - times[0] < MIN_DRIFT_SPAN:
+            return 0.0
+        offsets = [sample[1] for sample in self.history]
+        mean_time = sum(times) / len(times)
+        mean_offset = sum(offsets) / len(offsets)
+        covariance = sum((t - mean_time) * (o - mean_offset) for t, o in zip(times, offsets))
+        variance = sum((t - mean_time) ** 2 for t in times)
+        return covariance / variance
+
+    @property
+    def stale(self):
+        age = time.time() - self.last_sync
+        if age > RESYNC_SECONDS:
+            return True
+        # until the history spans long enough to estimate drift, sync again sooner
+        spanned = len(self.history) >= 2 and self.history[-1][0] - self.history[0][0] >= MIN_DRIFT_SPAN
+        return not spanned and age > MIN_DRIFT_SPAN
+
+    def offset_at(self, master_time):
+        return self.offset + self.drift * (master_time - self.reference)
+
+    def to_local(self, master_time):
+        return master_time + self.offset_at(master_time)
+
+    def to_master(self, local_time):
+        return (local_time - self.offset + self.drift * self.reference) / (1 + self.drift)
+
+    def master_time(self):
+        '''
+        drop-in replacement for time.time() on a remote, reading the master's clock
+        '''
+        return self.to_master(time.time())
+
+    def metrics(self, **labels):
+        yield 'holidayshows_clock_offset_seconds', labels, self.offset
+        yield 'holidayshows_clock_drift_ppm', labels, self.drift * 1e6
+        if self.last_sync:
+            yield 'holidayshows_clock_sync_age_seconds', labels, time.time() - self.last_sync
+
+    def state(self):
+        return {'offset': self.offset, 'drift': self.drift, 'reference': self.reference}
+
+    def load(self, state):
+        self.offset = state['offset']
+        self.drift = state['drift']
+        self.reference = state['reference']
+        self.last_sync = time.time()
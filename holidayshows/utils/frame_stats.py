@@ -0,0 +1,101 @@
+import select
+import socket
+import threading
+import time
+
+from . import metrics
+
+QUERY_TIMEOUT = 1.0
+
+metrics.describe('holidayshows_relay_report_sent_frames', 'gauge', 'Relay states sent to each box, in the latest dropped frame report')
+metrics.describe('holidayshows_relay_report_received_frames', 'gauge', 'Relay states each box received, in the latest dropped frame report')
+
+class FrameStats:
+    '''
+    dropped frame counts for every relay box, gathered on a background thread so a
+    box that doesn't answer never holds up the show.
+
+    request() asks for a new report and returns immediately. results holds the latest
+    numbers for each box, and each entry is replaced whole, never updated in place
+    '''
+    def __init__(self, remotes):
+        self.remotes = {name: remote for name, remote in remotes.items() if remote}
+        self.results = {}
+        self.previous = {name: {'sent': 0, 'suppressed': 0} for name in self.remotes}
+        # a socket of its own, so replies never mix with acknowledgements on the shared one
+        self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.requested = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='frame stats', daemon=True)
+        self.thread.start()
+
+    def request(self):
+        self.requested.set()
+
+    def run(self):
+        while True:
+            self.requested.wait()
+            self.requested.clear()
+            try:
+                self.collect()
+            except OSError as e:
+                print(f'error collecting frame stats: {e}')
+            self.report()
+
+    def collect(self):
+        '''
+        queries every box at once, then waits up to QUERY_TIMEOUT for all the replies
+        '''
+        by_ip = {}
+        for name, remote in self.remotes.items():
+            by_ip[remote.ip] = name
+            self.socket.sendto(bytes.fromhex('CC0000'), (remote.ip, remote.port))
+        received = {}
+        deadline = time.time() + QUERY_TIMEOUT
+        while len(received) < len(by_ip):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select([self.socket], [], [], remaining)
+            if not readable:
+                break
+            message, (returnIP, returnPort) = self.socket.recvfrom(64)
+            if returnIP in by_ip and message[0] == 0xCC:
+                received[by_ip[returnIP]] = int.from_bytes(message[1:3], 'big')
+
+        now = time.time()
+        for name, remote in self.remotes.items():
+            # the counters keep growing on the show thread, so only read them here
+            sent_total = remote.counter
+            suppressed_total = remote.suppressed
+            previous = self.previous[name]
+            result = {
+                'time': now,
+                'sent': sent_total - previous['sent'],
+                'suppressed': suppressed_total - previous['suppressed'],
+                'received': received.get(name),
+            }
+            if remote.extended:
+                result['link'] = remote.link_stats()
+            self.previous[name] = {'sent': sent_total, 'suppressed': suppressed_total}
+            self.results[name] = result
+
+    def metrics(self):
+        for name, result in list(self.results.items()):
+            labels = {'box': name}
+            yield 'holidayshows_relay_report_sent_frames', labels, result['sent']
+            yield 'holidayshows_relay_report_received_frames', labels, result['received']
+
+    def report(self):
+        for name in self.remotes:
+            result = self.results.get(name)
+            if result is None:
+                continue
+            received, sent, suppressed = result['received'], result['sent'], result['suppressed']
+            if received is None:
+                print(f'{name}: error getting frames')
+            elif sent:
+                print(f'{name}: received {received} of {sent} frames ({received/sent:.0%} success), {suppressed} unchanged frames not sent')
+            else:
+                print(f'{name}: no frames sent, {suppressed} unchanged frames not sent')
+            if 'link' in result:
+                print(f'{name}: {result["link"]}')
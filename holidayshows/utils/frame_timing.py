@@ -0,0 +1,124 @@
+from bisect import bisect_right
+import time
+
+from . import metrics
+
+MILLISECOND_EDGES = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+ROW_EDGES = (1, 2, 3, 5, 10, 20, 50)
+
+metrics.describe('holidayshows_frame_lateness_seconds', 'histogram', 'How late rows were shown, since the song started')
+metrics.describe('holidayshows_frame_skipped_rows', 'histogram', 'Rows skipped before each row shown, since the song started')
+metrics.describe('holidayshows_strip_show_seconds', 'histogram', 'How long each strip show() took, since the song started')
+metrics.describe('holidayshows_strip_throttle_wait_seconds', 'histogram', 'How long each show() waited for the strip to be ready, since the song started')
+metrics.describe('holidayshows_song_index', 'gauge', 'The song playing, or played last')
+
+class Histogram(object):
+    '''
+    counts values into fixed bins, so recording one costs the same however long a song runs.
+    bin i holds values from edges[i-1] up to edges[i], with one more bin for the rest
+    '''
+    def __init__(self, edges):
+        self.edges = edges
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.edges) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect_right(self.edges, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def labels(self):
+        bounds = ('0',) + tuple(str(edge) for edge in self.edges)
+        return [f'{low}-{high}' for low, high in zip(bounds, bounds[1:])] + [f'{bounds[-1]}+']
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'max': self.max,
+            'edges': list(self.edges),
+            'counts': list(self.counts),
+        }
+
+class FrameTiming(object):
+    '''
+    how one song went on a strip: how late each row was shown, how many rows were skipped
+    to catch up, how long show() took, and how long show() waited for the strip to be ready
+    '''
+    def __init__(self):
+        self.lateness = Histogram(MILLISECOND_EDGES)
+        self.skipped = Histogram(ROW_EDGES)
+        self.show_duration = Histogram(MILLISECOND_EDGES)
+        self.throttle_wait = Histogram(MILLISECOND_EDGES)
+        self.start(None, None)
+
+    def start(self, index, fps):
+        self.index = index
+        self.fps = fps
+        self.started = time.time()
+        for histogram in self.histograms().values():
+            histogram.reset()
+
+    def histograms(self):
+        return {
+            'lateness_ms': self.lateness,
+            'skipped_rows': self.skipped,
+            'show_ms': self.show_duration,
+            'throttle_wait_ms': self.throttle_wait,
+        }
+
+    def frame(self, lateness, skipped):
+        '''
+        lateness in seconds, of the row about to be shown. skipped counts the rows
+        jumped over since the last one
+        '''
+        self.lateness.add(lateness * 1000)
+        self.skipped.add(skipped)
+
+    def show(self, wait, duration):
+        self.throttle_wait.add(wait * 1000)
+        self.show_duration.add(duration * 1000)
+
+    def summary(self):
+        frames = self.lateness.count
+        rows = frames + self.skipped.total
+        summary = {
+            'index': self.index,
+            'fps': self.fps,
+            'seconds': time.time() - self.started,
+            'frames': frames,
+            'rows_skipped': self.skipped.total,
+            'dropped': self.skipped.total / rows if rows else 0,
+        }
+        for name, histogram in self.histograms().items():
+            summary[name] = histogram.summary()
+        return summary
+
+    def metrics(self, **labels):
+        if self.index is not None:
+            yield 'holidayshows_song_index', labels, self.index
+        yield from metrics.histogram('holidayshows_frame_lateness_seconds', self.lateness, 0.001, **labels)
+        yield from metrics.histogram('holidayshows_frame_skipped_rows', self.skipped, **labels)
+        yield from metrics.histogram('holidayshows_strip_show_seconds', self.show_duration, 0.001, **labels)
+        yield from metrics.histogram('holidayshows_strip_throttle_wait_seconds', self.throttle_wait, 0.001, **labels)
+
+    def report(self):
+        summary = self.summary()
+        playing = 'live rows' if self.index is None else f'song {self.index}'
+        print(f'{playing}: {summary["frames"]} frames shown, {summary["rows_skipped"]} rows skipped ({summary["dropped"]:.1%} dropped)')
+        for name, histogram in self.histograms().items():
+            if not histogram.count:
+                continue
+            print(f'{name}: mean {histogram.total / histogram.count:.2f}, max {histogram.max:.2f}')
+            most = max(histogram.counts)
+            for label, count in zip(histogram.labels(), histogram.counts):
+                if count:
+                    block = '|' * max(int(count / most * 50), 1)
+                    print(f'  {label:>9s} {count:>6d} {block}')
@@ -2,9 +2,18 @@
 
 import time
 
-from . import relay, remote_client
+from . import frame_stats, live_stream, metrics, relay, remote_client
 from .players import PLAYER_KINDS
 
+metrics.describe('holidayshows_relay_states_sent_total', 'counter', 'Relay states sent to each box')
+metrics.describe('holidayshows_relay_states_suppressed_total', 'counter', 'Unchanged relay states not sent to each box')
+metrics.describe('holidayshows_relay_acks_requested_total', 'counter', 'Acknowledgements asked of each box')
+metrics.describe('holidayshows_relay_acks_received_total', 'counter', 'Acknowledgements received from each box')
+metrics.describe('holidayshows_relay_acks_reordered_total', 'counter', 'Acknowledgements from each box that arrived after a later one')
+metrics.describe('holidayshows_relay_acks_duplicated_total', 'counter', 'Acknowledgements from each box received more than once')
+metrics.describe('holidayshows_relay_round_trip_seconds_sum', 'counter', 'Total round trip time of acknowledged relay states')
+metrics.describe('holidayshows_relay_round_trip_max_seconds', 'gauge', 'Longest round trip of an acknowledged relay state')
+
 class Home(object):
     def __init__(self, globals_):
         self.globals = globals_
@@ -15,7 +24,7 @@ class Home(object):
 
     def init_remote_clients(self):
         print('Initializing Remotes')
-        self.remote_clients = {}
+        self.remote_clients = remote_client.Remote_Pool()
         for name, config in self.globals['remotes'].items():
             client = remote_client.Remote_Client(name, config)
             self.remote_clients[name] = client
@@ -29,8 +38,17 @@ class Home(object):
 
     def init_strips(self):
         print('Initializing Strips')
+        self.strip_clients = {}
         for strip_config in self.globals['strips']:
-            self.remote_clients[strip_config['name']].add_player(PLAYER_KINDS.STRIP, strip_config)
+            client = self.remote_clients[strip_config['remote']]
+            client.add_player(PLAYER_KINDS.STRIP, strip_config)
+            self.strip_clients[strip_config['name']] = client
+
+    def clients_with_strips(self):
+        '''
+        each remote with a strip once, however many strips it has
+        '''
+        return list({client.name: client for client in self.strip_clients.values()}.values())
 
     def init_relays(self):
         self.relays = {}
@@ -58,6 +76,7 @@ class Home(object):
                 unassigned.remove(relay_name)
         if unassigned:
             raise ValueError(f'Unassigned relays: {unassigned}')
+        self.frame_stats = frame_stats.FrameStats(self.remotes)
 
     def show_relays(self, do_print=False):
         for remote in self.remotes.values():
@@ -68,16 +87,47 @@ class Home(object):
             print()
 
     def report_dropped_frames(self):
-        for name, remote in self.remotes.items():
-            try:
-                received, sent = remote.get_frames()
-            except:
-                print(f'{name}: error getting frames')
-            else:
-                if sent:
-                    print(f'{name}: received {received} of {sent} frames ({received/sent:.0%} success)')
-                else:
-                    print(f'{name}: no frames sent')
+        '''
+        returns immediately. the report is printed from the background thread once every box answers
+        '''
+        self.frame_stats.request()
+
+    def metrics(self):
+        for remote in list(self.remotes.values()):
+            if remote:
+                yield from remote.metrics()
+        yield from self.frame_stats.metrics()
+        for name, client in list(self.remote_clients.items()):
+            if client.local:
+                yield from client.players.metrics()
+            elif client.connected:
+                yield from client.clock.metrics(remote=name)
+
+    def live_sender(self, latency=live_stream.LATENCY_SECONDS):
+        '''
+        a sender with every strip added, by the strip's name
+        '''
+        sender = live_stream.Live_Sender(latency)
+        for strip_config in self.globals['strips']:
+            client = self.strip_clients[strip_config['name']]
+            sender.add(strip_config['name'], client.ip or '127.0.0.1', strip_config.get('live_port') or live_stream.LIVE_PORT)
+        return sender
+
+    def report_frame_timing(self):
+        '''
+        how the latest song went on each remote's strips, asked once it's done playing
+        '''
+        for client in self.clients_with_strips():
+            name = client.name
+            summaries = client.frame_timing()
+            if not summaries:
+                continue
+            summary = summaries[-1]
+            lateness = summary['lateness_ms']
+            print(f'{name}: song {summary["index"]}, {summary["frames"]} frames shown, '
+                  f'{summary["rows_skipped"]} rows skipped ({summary["dropped"]:.1%} dropped), '
+                  f'late by {lateness["mean"]:.1f} ms on average and {lateness["max"]:.1f} ms at most, '
+                  f'show() {summary["show_ms"]["mean"]:.2f} ms')
 
     def report_relay_duty_cycles(self):
         results = []
@@ -92,10 +142,18 @@ class Home(object):
         return self
 
     def cleanup(self):
-        for client in self.remote_clients:
-            self.remote_clients[client].disconnect()
         self.clear_relays()
 
+    def heartbeat(self):
+        self.remote_clients.heartbeat()
+
+    def close(self):
+        '''
+        ends the remote sessions, which otherwise stay open from one run to the next
+        '''
+        self.cleanup()
+        self.remote_clients.close()
+
     def __exit__(self, *args, **kwargs):
         self.cleanup()
         print('Complete')
@@ -0,0 +1,111 @@
+'''
+compiled images for the remotes
+
+a PNG has to be decoded in full to get at any of its columns, but each strip only
+needs a few of them. a compiled asset stores the image as chunks of CHUNK_WIDTH
+columns, each chunk row-major, after a small header, so a slice of columns (or of
+rows within them) can be read through a memory map without touching the rest.
+
+    python3 -m holidayshows.utils.image_asset [image.png ...]
+
+compiles the given images, or every PNG under holidayshows/images
+'''
+
+import glob
+import os
+import struct
+import sys
+
+from PIL import Image
+import numpy as np
+
+MAGIC = b'HSASSET1'
+HEADER = struct.Struct('!8sIIII')  # magic, height, width, channels, chunk width
+HEADER_SIZE = 64  # header is padded so chunk data is aligned
+CHUNK_WIDTH = 64
+EXTENSION = '.hsa'
+
+def asset_path(image_path):
+    return os.path.splitext(image_path)[0] + EXTENSION
+
+def is_current(compiled_path, image_path):
+    return (os.path.exists(compiled_path) and
+            os.path.getmtime(compiled_path) >= os.path.getmtime(image_path))
+
+def compile_image(image_path, compiled_path=None, chunk_width=CHUNK_WIDTH):
+    if compiled_path is None:
+        compiled_path = asset_path(image_path)
+    image = Image.open(image_path)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGB')
+    image_data = np.asarray(image, dtype=np.uint8)
+    height, width, channels = image_data.shape
+    chunk_count = -(-width // chunk_width)
+    padded_width = chunk_count * chunk_width
+    if padded_width != width:
+        image_data = np.pad(image_data, ((0, 0), (0, padded_width - width), (0, 0)))
+    # (height, chunks, chunk width, channels) -> (chunks, height, chunk width, channels)
+    chunks = image_data.reshape(height, chunk_count, chunk_width, channels).transpose(1, 0, 2, 3)
+
+    temporary_path = compiled_path + '.tmp'
+    with open(temporary_path, 'wb') as asset_file:
+        header = HEADER.pack(MAGIC, height, width, channels, chunk_width)
+        asset_file.write(header.ljust(HEADER_SIZE, b'\0'))
+        asset_file.write(np.ascontiguousarray(chunks).tobytes())
+    os.replace(temporary_path, compiled_path)
+    print(f'compiled {image_path} ({width}x{height}) to {compiled_path}')
+    return compiled_path
+
+class ImageAsset:
+    '''
+    read-only, array-like view of a compiled image. only [rows, columns] slicing is supported
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as asset_file:
+            header = asset_file.read(HEADER.size)
+        magic, self.height, self.width, self.channels, self.chunk_width = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a compiled image')
+        chunk_count = -(-self.width // self.chunk_width)
+        self.chunks = np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER_SIZE,
+                                shape=(chunk_count, self.height, self.chunk_width, self.channels))
+
+    @property
+    def shape(self):
+        return self.height, self.width, self.channels
+
+    def __len__(self):
+        return self.height
+
+    @property
+    def nbytes(self):
+        '''
+        size of the mapping. pages only become resident as columns are read
+        '''
+        return self.chunks.nbytes
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        rows, columns = key
+        start, stop, step = columns.indices(self.width)
+        if step != 1:
+            raise IndexError('column slices must be contiguous')
+        if stop <= start:
+            # e.g. starting at or past the width, which the slicer pads or wraps
+            return np.array(self.chunks[0, rows][:, :0])
+        first = start // self.chunk_width
+        last = (stop - 1) // self.chunk_width
+        parts = [self.chunks[chunk, rows] for chunk in range(first, last + 1)]
+        joined = np.concatenate(parts, axis=1) if len(parts) > 1 else parts[0]
+        offset = first * self.chunk_width
+        return np.array(joined[:, start - offset:stop - offset])
+
+if __name__ == '__main__':
+    paths = sys.argv[1:]
+    if not paths:
+        images = os.path.join(os.path.dirname(__file__), '..', 'images')
+        paths = glob.glob(os.path.join(images, '**', '*.png'), recursive=True)
+    for path in paths:
+        compile_image(path)
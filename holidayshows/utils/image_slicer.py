@@ -1,31 +1,131 @@
+from collections import OrderedDict
 import os
+import threading
 
 from PIL import Image
 import numpy as np
 
+from . import image_asset
+
+CACHE_BYTES = 64 * 1024 * 1024
+CACHE_SLICES = False  # cache the slices each strip asks for, rather than whole images
+
+class ImageCache:
+    '''
+    least recently used cache, limited by the total nbytes of what it holds
+    '''
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        value = load()
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = value
+                self.nbytes += value.nbytes
+            self.evict()
+        return value
+
+    def evict(self):
+        # the newest entry stays, even if it is over budget by itself
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, value = self.entries.popitem(last=False)
+            self.nbytes -= value.nbytes
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def __str__(self):
+        return (f'{len(self.entries)} entries, {self.nbytes / 1e6:.1f} of {self.max_bytes / 1e6:.1f} MB, '
+                f'{self.hits} hits, {self.misses} misses, {self.evictions} evictions')
+
 class ImageSlicer:
     _instance = None
-    images: dict
+    cache: ImageCache
+    cache_slices: bool
     def __new__(cls):
         if not cls._instance:
             self = cls._instance = object.__new__(cls)
-            self.images = {}
+            self.cache = ImageCache()
+            self.cache_slices = CACHE_SLICES
         return cls._instance
 
+    def configure(self, max_bytes=None, cache_slices=None):
+        if cache_slices is not None and cache_slices != self.cache_slices:
+            self.cache_slices = cache_slices
+            self.cache.clear()
+        if max_bytes is not None:
+            self.cache.resize(max_bytes)
+
     def slice_image(self, path, start, end, wrap=False, bw=False):
-        if path not in self.images:
-            self.images[path] = self.load_image(path)
-        return self._slice_image(self.images[path], start, end, wrap, bw)
+        if self.cache_slices:
+            def load():
+                image_slice = self._slice_image(self.load_image(path), start, end, wrap, bw)
+                image_slice.setflags(write=False)  # shared by everyone who asks for this slice
+                return image_slice
+            return self.cache.get((path, start, end, wrap, bw), load)
+        image = self.cache.get(path, lambda: self.load_image(path))
+        return self._slice_image(image, start, end, wrap, bw)
+
+    def iter_slice(self, path, start, end, wrap=False, block_rows=256):
+        '''
+        yields the slice a block of rows at a time, without caching it or the whole image
+        '''
+        image = self.load_image(path)
+        for first in range(0, len(image), block_rows):
+            yield self._slice_image(image, start, end, wrap, rows=slice(first, first + block_rows))
 
     def load_image(self, path):
+        '''
+        memory maps the compiled version of the image, compiling it first if needed.
+        only the columns that get sliced are ever read from disk
+        '''
         path = os.path.join(os.path.dirname(__file__), '..', path)
         path = os.path.realpath(path)
-        image = Image.open(path)
-        image_data = np.asarray(image, dtype=np.uint8)
-        return image_data
+        if path.endswith(image_asset.EXTENSION):
+            return image_asset.ImageAsset(path)
+        compiled_path = image_asset.asset_path(path)
+        if not image_asset.is_current(compiled_path, path):
+            try:
+                image_asset.compile_image(path, compiled_path)
+            except OSError as e:
+                print(f'could not compile {path}: {e}')
+                image = Image.open(path)
+                return np.asarray(image, dtype=np.uint8)
+        return image_asset.ImageAsset(compiled_path)
 
-    def _slice_image(self, image, start, end, wrap=False, bw=False):
-        image_slice = image[:, start:end]
+    def _slice_image(self, image, start, end, wrap=False, bw=False, rows=slice(None)):
+        image_slice = image[rows, start:end]
         if bw:
             image_slice = self.booleanize(image_slice)
         needed_width = end - start
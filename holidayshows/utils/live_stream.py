@@ -0,0 +1,169 @@
+'''
+rows streamed to strips as they are made, rather than loaded ahead of time
+
+a sender stamps each row with the master time it should be shown, a little ahead of
+now, and sends it over UDP. each packet is ROW_HEADER, the strip's name, then r, g, b
+for every pixel. every sender picks a session id of its own, and numbers its rows from 1. the remote packs rows as they arrive and keeps them in a jitter buffer
+for the player, which shows each one when its time comes
+'''
+
+from collections import defaultdict
+import heapq
+import itertools
+import random
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+from . import relay
+
+LIVE_PORT = 2702
+LATENCY_SECONDS = 0.1  # how far ahead rows are stamped, to cover the network and the remote
+BUFFER_ROWS = 64
+POLL_SECONDS = 0.005  # how often a player with nothing buffered looks again
+MAGIC = b'HL'
+VERSION = 2
+# magic, version, session id, sequence number, time to show, length of the strip name
+ROW_HEADER = struct.Struct('!2sBIIdB')
+MAX_PACKET = 65507
+
+class Jitter_Buffer(object):
+    '''
+    packed rows in order of when they are due. the receiver thread pushes, the player pops
+    '''
+    def __init__(self, capacity=BUFFER_ROWS):
+        self.capacity = capacity
+        self.rows = []  # heap of (show at, sequence, push count, row)
+        self.lock = threading.Lock()
+        self.session = None
+        self.tracker = relay.SequenceTracker()
+        self.overflowed = 0
+        self.pushed = itertools.count()
+
+    def push(self, show_at, session, sequence, row):
+        with self.lock:
+            if session != self.session:
+                # a new sender numbers its rows from 1 again, so they aren't repeats of the last one's
+                self.session = session
+                self.tracker = relay.SequenceTracker()
+            if self.tracker.track(sequence) is None:
+                return  # a repeat, already buffered or shown
+            # the count keeps rows from ever being compared, should a sender start again mid-buffer
+            heapq.heappush(self.rows, (show_at, sequence, next(self.pushed), row))
+            if len(self.rows) > self.capacity:
+                heapq.heappop(self.rows)  # the player is behind, so it would be skipped anyway
+                self.overflowed += 1
+
+    def due(self, now):
+        '''
+        returns (show at, row, skipped) for the latest row due by now, or None.
+        rows due before it are dropped and counted as skipped
+        '''
+        with self.lock:
+            latest = None
+            skipped = -1
+            while self.rows and self.rows[0][0] <= now:
+                latest = heapq.heappop(self.rows)
+                skipped += 1
+        if latest is None:
+            return None
+        show_at, sequence, _, row = latest
+        return show_at, row, skipped
+
+    def next_time(self):
+        with self.lock:
+            return self.rows[0][0] if self.rows else None
+
+    def discard_before(self, when):
+        with self.lock:
+            while self.rows and self.rows[0][0] < when:
+                heapq.heappop(self.rows)
+
+    def __str__(self):
+        return f'{len(self.rows)} rows buffered, {self.overflowed} overflowed, {self.tracker}'
+
+class Live_Receiver(object):
+    '''
+    one per port, shared by every strip in the process, handing rows to each strip's
+    buffer by name
+    '''
+    _instances = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, port=LIVE_PORT):
+        with cls._lock:
+            if port not in cls._instances:
+                cls._instances[port] = cls(port)
+            return cls._instances[port]
+
+    def __init__(self, port):
+        self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.socket.bind(('', port))
+        self.channels = {}
+        self.unknown = 0
+        self.invalid = 0
+        print(f'receiving live rows on port {port}')
+        self.thread = threading.Thread(target=self.run, name='live rows', daemon=True)
+        self.thread.start()
+
+    def register(self, name, pack):
+        '''
+        pack turns (rows, pixels, rgb) into the strip's packed rows
+        '''
+        buffer = Jitter_Buffer()
+        self.channels[name] = (buffer, pack)
+        return buffer
+
+    def run(self):
+        while True:
+            message, address = self.socket.recvfrom(MAX_PACKET)
+            try:
+                self.handle(message)
+            except (ValueError, struct.error) as e:
+                self.invalid += 1
+                print(f'invalid live row from {address[0]}: {e}')
+
+    def handle(self, message):
+        magic, version, session, sequence, show_at, name_length = ROW_HEADER.unpack_from(message)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'unexpected header {message[:ROW_HEADER.size]}')
+        start = ROW_HEADER.size + name_length
+        name = message[ROW_HEADER.size:start].decode()
+        channel = self.channels.get(name)
+        if channel is None:
+            self.unknown += 1
+            return
+        buffer, pack = channel
+        pixels = np.frombuffer(message, dtype=np.uint8, offset=start).reshape(1, -1, 3)
+        buffer.push(show_at, session, sequence, pack(pixels)[0])
+
+class Live_Sender(object):
+    def __init__(self, latency=LATENCY_SECONDS, clock=time.time):
+        self.latency = latency
+        self.clock = clock
+        self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.strips = {}
+        self.session = random.getrandbits(32)
+        self.sequences = defaultdict(int)
+
+    def add(self, name, host, port=LIVE_PORT):
+        # resolved once, so host names don't cost a lookup every row
+        self.strips[name] = (socket.gethostbyname(host), port)
+
+    def send(self, name, pixels, show_at=None):
+        '''
+        pixels is (pixels, rgb) for the named strip. show_at defaults to latency from now
+        '''
+        if show_at is None:
+            show_at = self.clock() + self.latency
+        self.sequences[name] += 1
+        encoded = name.encode()
+        header = ROW_HEADER.pack(MAGIC, VERSION, self.session, self.sequences[name] & 0xFFFFFFFF, show_at, len(encoded))
+        try:
+            self.socket.sendto(header + encoded + np.ascontiguousarray(pixels, dtype=np.uint8).tobytes(), self.strips[name])
+        except OSError as e:
+            print(f'error sending live row to {name}: {e}')
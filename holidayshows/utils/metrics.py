@@ -0,0 +1,157 @@
+'''
+metrics in Prometheus text format, served over HTTP from a background thread
+
+nothing is collected on the show's own thread. each process registers collectors,
+functions that yield (name, labels, value) samples from counters that already exist,
+and they only run when /metrics is scraped. the counters are plain numbers updated
+without locks, so a scrape may see one frame's worth of change only partly applied.
+values that have no other home, such as how long a load took, are kept with set_value()
+'''
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import resource
+import threading
+import traceback
+
+CONTROLLER_PORT = 9700
+REMOTE_PORT = 9701
+RELAY_PORT = 9702
+
+DESCRIPTIONS = {
+    'holidayshows_up': ('gauge', 'Always 1 while the process is running'),
+    'holidayshows_resident_memory_bytes': ('gauge', 'Resident memory of the process'),
+    'holidayshows_max_resident_memory_bytes': ('gauge', 'Most resident memory the process has used'),
+    'holidayshows_image_cache_entries': ('gauge', 'Images or slices held by the image cache'),
+    'holidayshows_image_cache_bytes': ('gauge', 'Bytes held by the image cache'),
+    'holidayshows_image_cache_max_bytes': ('gauge', 'Most bytes the image cache will hold'),
+    'holidayshows_image_cache_hits_total': ('counter', 'Image cache lookups that were already loaded'),
+    'holidayshows_image_cache_misses_total': ('counter', 'Image cache lookups that had to load'),
+    'holidayshows_image_cache_evictions_total': ('counter', 'Entries dropped from the image cache'),
+    'holidayshows_load_seconds': ('gauge', 'How long the latest load of each player kind took on this remote'),
+    'holidayshows_song_load_seconds': ('gauge', 'How long the latest song took to load on each remote, by category, as seen by the show'),
+}
+
+_collectors = []
+_values = {}
+
+def describe(name, kind, help_text):
+    DESCRIPTIONS[name] = (kind, help_text)
+
+def register(collector):
+    _collectors.append(collector)
+
+def set_value(name, value, **labels):
+    # replacing one item in a dict is atomic, so this needs no lock
+    _values[name, tuple(sorted(labels.items()))] = value
+
+def histogram(name, values, scale=1, **labels):
+    '''
+    samples for a frame_timing.Histogram. its counts are per bin, prometheus buckets are cumulative.
+    scale converts the histogram's units, e.g. 0.001 for milliseconds to seconds
+    '''
+    counts = list(values.counts)
+    total = 0
+    for edge, count in zip(list(values.edges) + ['+Inf'], counts):
+        total += count
+        le = edge if edge == '+Inf' else format_value(edge * scale)
+        yield f'{name}_bucket', dict(labels, le=le), total
+    yield f'{name}_sum', labels, values.total * scale
+    yield f'{name}_count', labels, total
+
+def collect_process():
+    yield 'holidayshows_up', {}, 1
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        yield 'holidayshows_resident_memory_bytes', {}, pages * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        pass
+    # kilobytes on linux
+    yield 'holidayshows_max_resident_memory_bytes', {}, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def collect_image_cache():
+    from . import image_slicer
+    stats = image_slicer.ImageSlicer().cache.stats()
+    yield 'holidayshows_image_cache_entries', {}, stats['entries']
+    yield 'holidayshows_image_cache_bytes', {}, stats['bytes']
+    yield 'holidayshows_image_cache_max_bytes', {}, stats['max_bytes']
+    yield 'holidayshows_image_cache_hits_total', {}, stats['hits']
+    yield 'holidayshows_image_cache_misses_total', {}, stats['misses']
+    yield 'holidayshows_image_cache_evictions_total', {}, stats['evictions']
+
+def collect_values():
+    for (name, labels), value in list(_values.items()):
+        yield name, dict(labels), value
+
+def format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+def family(name):
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and DESCRIPTIONS.get(name[:-len(suffix)], ('',))[0] == 'histogram':
+            return name[:-len(suffix)]
+    return name
+
+def render():
+    families = {}
+    for collector in [collect_process, collect_values] + _collectors:
+        try:
+            for name, labels, value in collector():
+                if value is None:
+                    continue
+                families.setdefault(family(name), []).append((name, labels, value))
+        except Exception:
+            # one broken collector shouldn't hide the rest
+            traceback.print_exc()
+    lines = []
+    for name, samples in families.items():
+        if name in DESCRIPTIONS:
+            kind, help_text = DESCRIPTIONS[name]
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+        for sample_name, labels, value in samples:
+            lines.append(f'{sample_name}{format_labels(labels)} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes would otherwise print a line every few seconds
+
+def serve(port, host=''):
+    '''
+    starts answering on http://host:port/metrics. a port of 0 or None serves nothing
+    '''
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), Handler)
+    except OSError as e:
+        print(f'metrics not served on port {port}: {e}')
+        return None
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    print(f'serving metrics on port {port}')
+    return server
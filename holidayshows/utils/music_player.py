@@ -10,6 +10,7 @@ class Music_Player():
         self.delay = 0
         self.config = config
         self.songs = defaultdict(lambda: None)
+        self.still_playing = []  # unloaded songs that haven't finished, since freeing a sound stops it
 
     def load_data(self, arguments):
         index = arguments['index']
@@ -24,21 +25,32 @@ class Music_Player():
         self.songs[index] = mixer.Sound(music)
 
     def play(self, arguments):
+        if arguments.get('live'):
+            return  # live rows are only for strips
         index = arguments['index']
         repeat = arguments['repeat']
         end_by = arguments['end_by']
         epoch = arguments['epoch']
         fps = arguments['fps']
+        clock = arguments.get('clock', time.time)
 
         song = self.songs[index]
         if song:
-            while time.time() < epoch + self.delay:
-                time.sleep(0.001)
-                yield 'waiting for start time'
+            while clock() < epoch + self.delay:
+                yield epoch + self.delay
             song.play()
-            yield 'song playing'
-        else:
-            yield 'no song to play'
 
-    def stop(self):
+    def loaded(self):
+        return sorted(index for index, song in list(self.songs.items()) if song)
+
+    def unload(self, index):
+        self.still_playing = [song for song in self.still_playing if song.get_num_channels()]
+        song = self.songs.pop(index, None)
+        if song and song.get_num_channels():
+            self.still_playing.append(song)
+
+    def abort(self):
         mixer.stop()
+
+    def stop(self):
+        self.abort()
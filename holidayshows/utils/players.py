@@ -1,4 +1,7 @@
 from enum import IntEnum
+import time
+
+from . import scheduler
 
 class PLAYER_KINDS(IntEnum):
     MUSIC = 1
@@ -6,20 +9,17 @@ class PLAYER_KINDS(IntEnum):
 
 class Players(dict):
     def play_all(self, arguments):
-        players = []
+        '''
+        yields the next deadline of any player, so it can be driven by a scheduler.Scheduler
+        '''
+        schedule = scheduler.Scheduler(arguments.get('clock', time.time))
         for player in self.values():
-            players.append(player.play(arguments))
-        while True:
-            still_going = False
-            for player in players:
-                try:
-                    yield next(player)
-                    still_going = True
-                except StopIteration:
-                    pass
-            if not still_going:
-                break
-        print(f'all {len(players)} players finished')
+            schedule.add(player.play(arguments))
+        try:
+            yield from schedule
+        finally:
+            schedule.close()
+        print(f'all {len(schedule)} players finished')
 
     def add(self, player_kind, player_globals):
         print('Adding player', player_kind, 'with globals', player_globals)
@@ -27,13 +27,47 @@ class Players(dict):
             from . import music_player
             self[PLAYER_KINDS.MUSIC] = music_player.Music_Player(player_globals)
         elif player_kind == PLAYER_KINDS.STRIP:
+            if PLAYER_KINDS.STRIP in self:
+                # every strip on a remote is played together
+                self[PLAYER_KINDS.STRIP].add_strip(player_globals)
+                return
             from . import strip_player
             self[PLAYER_KINDS.STRIP] = strip_player.Strip_Player(player_globals)
         else:
             raise ValueError(f'Unknown player kind: {player_kind}')
 
+    def frame_timing(self):
+        '''
+        frame timing summaries of the latest songs, if there is a strip
+        '''
+        player = self.get(PLAYER_KINDS.STRIP)
+        return player.frame_timing() if player else []
+
+    def loaded(self):
+        '''
+        the song indexes each player has loaded, by the player's kind
+        '''
+        return {kind.name.lower(): player.loaded() for kind, player in list(self.items())}
+
+    def abort(self):
+        '''
+        cuts off anything a player started that carries on without it, like music
+        '''
+        for player in list(self.values()):
+            if hasattr(player, 'abort'):
+                player.abort()
+
+    def metrics(self):
+        for player in list(self.values()):
+            if hasattr(player, 'metrics'):
+                yield from player.metrics()
+
     def load_data(self, player_kind, data):
         try:
             self[player_kind].load_data(data)
         except KeyError:
             raise ValueError(f'{player_kind} has not been added yet. Call add() first.') from None
+
+    def unload(self, player_kind, index):
+        if player_kind in self:
+            self[player_kind].unload(index)
@@ -0,0 +1,143 @@
+'''
+framing for messages between Remote_Client and Remote_Server
+
+every frame is a fixed header, then a JSON body, then any raw numpy buffers
+the body refers to. numpy arrays anywhere in the body are replaced by a small
+placeholder so they travel as bytes instead of JSON lists.
+
+a response carries the request id of the request it answers, since the server
+answers other requests while a song plays and its response is still to come.
+'''
+
+import asyncio
+import json
+import socket
+import struct
+
+import numpy as np
+
+VERSION = 2
+MAGIC = b'HS'
+
+REQUEST = 1
+NOTIFY = 2  # a request that gets no response
+RESPONSE = 3
+ERROR = 4
+
+# magic, version, kind, request id, body length, buffers length
+HEADER = struct.Struct('!2sBBIII')
+
+class ProtocolError(Exception):
+    pass
+
+class RemoteError(Exception):
+    pass
+
+def _extract_buffers(value, buffers):
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        buffers.append(value)
+        return {'__buffer__': len(buffers) - 1}
+    if isinstance(value, dict):
+        return {key: _extract_buffers(item, buffers) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_extract_buffers(item, buffers) for item in value]
+    return value
+
+def _restore_buffers(value, buffers):
+    if isinstance(value, dict):
+        if '__buffer__' in value:
+            return buffers[value['__buffer__']]
+        return {key: _restore_buffers(item, buffers) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_restore_buffers(item, buffers) for item in value]
+    return value
+
+def encode_frame(kind, body, request_id=0):
+    '''
+    returns the frame as a list of buffers, to be written in order
+    '''
+    buffers = []
+    body = _extract_buffers(body, buffers)
+    offset = 0
+    layout = []
+    for buffer in buffers:
+        layout.append({'offset': offset, 'dtype': buffer.dtype.str, 'shape': buffer.shape})
+        offset += buffer.nbytes
+    body_bytes = json.dumps({'body': body, 'buffers': layout}).encode()
+    header = HEADER.pack(MAGIC, VERSION, kind, request_id, len(body_bytes), offset)
+    # an empty array has no bytes to send, and memoryview can't cast it anyway
+    return [header + body_bytes] + [memoryview(buffer).cast('B') for buffer in buffers if buffer.size]
+
+def send_frame(sock, kind, body, request_id=0):
+    for chunk in encode_frame(kind, body, request_id):
+        sock.sendall(chunk)
+
+def recv_exactly(sock, length):
+    data = bytearray(length)
+    view = memoryview(data)
+    received = 0
+    while received < length:
+        count = sock.recv_into(view[received:], length - received)
+        if not count:
+            raise ConnectionError('connection closed mid-frame')
+        received += count
+    return data
+
+def parse_header(header):
+    '''
+    returns (kind, request id, body length, buffers length)
+    '''
+    magic, version, kind, request_id, body_length, buffers_length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError(f'invalid frame header: {bytes(header)}')
+    if version != VERSION:
+        raise ProtocolError(f'protocol version {version} received, expected {VERSION}')
+    return kind, request_id, body_length, buffers_length
+
+def recv_frame(sock):
+    '''
+    returns (kind, request id, body), or (None, None, None) if the connection was closed between frames
+    '''
+    try:
+        header = recv_exactly(sock, HEADER.size)
+    except ConnectionError:
+        return None, None, None
+    kind, request_id, body_length, buffers_length = parse_header(header)
+    message = recv_exactly(sock, body_length)
+    data = recv_exactly(sock, buffers_length)
+    return kind, request_id, decode_body(message, data)
+
+async def read_frame(reader):
+    '''
+    recv_frame, for an asyncio stream
+    '''
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None, None, None
+    kind, request_id, body_length, buffers_length = parse_header(header)
+    try:
+        message = await reader.readexactly(body_length)
+        data = bytearray(await reader.readexactly(buffers_length))  # writable, like recv_frame's
+    except asyncio.IncompleteReadError:
+        raise ConnectionError('connection closed mid-frame') from None
+    return kind, request_id, decode_body(message, data)
+
+def decode_body(message, data):
+    message = json.loads(message)
+    buffers = []
+    for layout in message['buffers']:
+        count = int(np.prod(layout['shape']))
+        if not count:
+            buffers.append(np.empty(layout['shape'], dtype=layout['dtype']))
+            continue
+        array = np.frombuffer(data, dtype=layout['dtype'], count=count, offset=layout['offset'])
+        buffers.append(array.reshape(layout['shape']))
+    return _restore_buffers(message['body'], buffers)
+
+def configure(sock):
+    '''
+    frames are written in one or two sendall calls, so don't let Nagle hold them back
+    '''
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
@@ -0,0 +1,56 @@
+import time
+
+import numpy as np
+
+FRAMES = 1024  # frames kept before the oldest are overwritten
+
+class Recording_Strip(object):
+    '''
+    stands in for Adafruit_NeoPixel without any hardware. every shown frame is copied,
+    with the time it was shown, into a ring buffer allocated up front.
+
+    with simulate, show() takes as long as the real strip would: like rpi_ws281x it
+    returns straight away, but waits first for the previous frame to finish sending
+    '''
+    def __init__(self, length, delay, frames=FRAMES, simulate=True):
+        self.length = length
+        self.delay = delay
+        self.simulate = simulate
+        self._led_data = np.zeros(length, dtype=np.uint32)
+        self.frames = np.zeros((frames, length), dtype=np.uint32)
+        self.times = np.zeros(frames)
+        self.count = 0
+        self.busy_until = 0
+
+    def begin(self):
+        self.count = 0
+        self.busy_until = 0
+
+    def numPixels(self):
+        return self.length
+
+    def setPixelColor(self, n, color):
+        self._led_data[n] = color
+
+    def getPixelColor(self, n):
+        return int(self._led_data[n])
+
+    def show(self):
+        now = time.time()
+        if self.simulate:
+            if self.busy_until > now:
+                time.sleep(self.busy_until - now)
+                now = time.time()
+            self.busy_until = now + self.delay
+        slot = self.count % len(self.frames)
+        self.frames[slot] = self._led_data
+        self.times[slot] = now
+        self.count += 1
+
+    def recorded(self):
+        '''
+        the frames still in the buffer and their times, oldest first
+        '''
+        kept = min(self.count, len(self.frames))
+        order = np.arange(self.count - kept, self.count) % len(self.frames)
+        return self.frames[order], self.times[order]
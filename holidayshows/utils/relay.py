@@ -1,14 +1,91 @@
 #! /usr/bin/env python3
 
+from collections import defaultdict, deque
+import heapq
 import math
+from random import uniform
+import select
 import socket
+import struct
+import threading
 import time
 
+import numpy as np
+
+KEEPALIVE_SECONDS = 1.0  # resend an unchanged state this often, in case a packet was lost
+ACK_EVERY = 10  # ask for an acknowledgement on every nth extended packet
+MISSING_WINDOW = 1024  # skipped sequence numbers remembered, to tell late packets from duplicates
+
+# a handshake of AA0001 asks whether the box understands extended packets.
+# boxes that do answer BB8001. the Arduino sketch answers BB0000, and older servers echo 0001
+EXTENDED_HANDSHAKE = 0x0001
+EXTENDED_VERSION = 0x8001
+# 0xEE, relay states, sequence number, send time, flags
+EXTENDED_STATE = struct.Struct('!BHIdB')
+ACK_REQUESTED = 0x01
+# 0xEF, sequence number, echoed send time
+ACK = struct.Struct('!BId')
+MAX_PACKET = 64
+
 class RelayClientException(Exception):
     pass
 
+class SequenceTracker(object):
+    '''
+    counts lost, out of order and duplicated packets from their sequence numbers.
+    step is the spacing of the numbers, for when only every nth packet is tracked
+    '''
+    def __init__(self, step=1):
+        self.step = step
+        self.highest = None
+        self.missing = set()  # skipped numbers that may yet arrive late
+        self.missing_order = deque()  # the same, oldest first, to forget them after MISSING_WINDOW
+        self.received = 0
+        self.lost = 0
+        self.reordered = 0
+        self.duplicates = 0
+
+    def track(self, sequence):
+        '''
+        returns True if this is the newest packet so far, False if it arrived after a later one,
+        or None if it was already seen
+        '''
+        if self.highest is not None and sequence <= self.highest - MISSING_WINDOW * self.step:
+            # too far back to be late, so the sender has started again
+            self.highest = None
+            self.missing.clear()
+            self.missing_order.clear()
+        if self.highest is None or sequence > self.highest:
+            if self.highest is not None:
+                skipped = range(self.highest + self.step, sequence, self.step)
+                self.lost += len(skipped)
+                for missing in skipped[-MISSING_WINDOW:]:
+                    self.missing.add(missing)
+                    self.missing_order.append(missing)
+                while len(self.missing_order) > MISSING_WINDOW:
+                    self.missing.discard(self.missing_order.popleft())
+            self.highest = sequence
+            self.received += 1
+            return True
+        if sequence in self.missing:
+            # counted as lost when a later packet came in
+            self.missing.discard(sequence)
+            self.received += 1
+            self.reordered += 1
+            self.lost -= 1
+            return False
+        self.duplicates += 1
+        return None
+
+    def __str__(self):
+        return f'{self.received} received, {self.lost} lost, {self.reordered} out of order, {self.duplicates} duplicated'
+
 class RelayRemote(dict):
     _socket: socket.socket
+    _by_ip = {}
+    # held for each exchange on the shared socket, so the ack thread never reads another's reply
+    _socket_lock = threading.Lock()
+    _ack_thread = None
 
     @classmethod
     def simple(cls, host):
@@ -22,6 +99,15 @@ class RelayRemote(dict):
         self.ip = config['host']
         self.invert = bool(config.get('invert', False))
         print(f'{self.name}: invert: {self.invert}')
+        self.keepalive = config.get('keepalive')
+        if self.keepalive is None:
+            self.keepalive = KEEPALIVE_SECONDS
+        self.last_state = None
+        self.last_sent = 0
+        self.suppressed = 0
+        self.extended = False
+        self.sequence = 0
+        self.reset_link_stats()
         self.port = 2700
         for i, relay_name in enumerate(config['relays']):
             if relay_name is None: continue
@@ -41,24 +127,115 @@ class RelayRemote(dict):
         if not hasattr(RelayRemote, '_socket'):
             RelayRemote._socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
 
-        message = 0xAA0000.to_bytes(3, 'big')
-        self._socket.sendto(message, (self.ip, self.port))
-        self._socket.settimeout(1)
-        try:
-            message, (returnIP, returnPort) = self._socket.recvfrom(3)
-        except socket.timeout:
-            raise RelayClientException(f'Timeout on handshake with {self.ip}:{self.port}') from None
+        message = (0xAA0000 | EXTENDED_HANDSHAKE).to_bytes(3, 'big')
+        with self._socket_lock:
+            self._socket.sendto(message, (self.ip, self.port))
+            self._socket.settimeout(1)
+            try:
+                message, (returnIP, returnPort) = self._socket.recvfrom(MAX_PACKET)
+            except socket.timeout:
+                raise RelayClientException(f'Timeout on handshake with {self.ip}:{self.port}') from None
         if int.from_bytes(message[:1], 'big') != 0xBB:
             raise RelayClientException(f'Invalid handshake message: {message}')
         message_value = int.from_bytes(message[1:3], 'big')
-        print(f'{returnIP} replied with {message_value} to handshake request to {self.name}')
+        self.extended = message_value == EXTENDED_VERSION
+        print(f'{returnIP} replied with {message_value} to handshake request to {self.name} ({"extended" if self.extended else "legacy"} packets)')
         self.ip = returnIP
+        RelayRemote._by_ip[self.ip] = self
+
+    @classmethod
+    def start_ack_receiver(cls):
+        with cls._socket_lock:
+            if cls._ack_thread is None:
+                cls._ack_thread = threading.Thread(target=cls.run_ack_receiver, name='relay acks', daemon=True)
+                cls._ack_thread.start()
+
+    @classmethod
+    def run_ack_receiver(cls):
+        '''
+        reads acknowledgements as they arrive, so each round trip is timed when it ends rather
+        than when the next state goes out, which may be a keepalive later
+        '''
+        while True:
+            select.select([cls._socket], [], [])
+            with cls._socket_lock:
+                cls.receive_acks()
+
+    @classmethod
+    def receive_acks(cls):
+        '''
+        reads any acknowledgements waiting on the shared socket, without blocking
+        '''
+        cls._socket.setblocking(False)  # handshake and get_frames set their own timeout
+        while True:
+            try:
+                message, (returnIP, returnPort) = cls._socket.recvfrom(MAX_PACKET)
+            except BlockingIOError:
+                return
+            cls.dispatch_ack(message, returnIP)
+
+    @classmethod
+    def dispatch_ack(cls, message, ip):
+        if len(message) == ACK.size and message[0] == 0xEF and ip in cls._by_ip:
+            _, sequence, sent = ACK.unpack(message)
+            cls._by_ip[ip].receive_ack(sequence, sent)
+        else:
+            print(f'unexpected message from {ip}: {message}')
+
+    def receive_ack(self, sequence, sent):
+        if self.ack_tracker.track(sequence) is None:
+            return  # already counted
+        round_trip = time.time() - sent
+        self.acks_received += 1
+        self.total_round_trip += round_trip
+        self.max_round_trip = max(self.max_round_trip, round_trip)
+
+    def reset_link_stats(self):
+        self.acks_requested = 0
+        self.acks_received = 0
+        self.ack_tracker = SequenceTracker(ACK_EVERY)
+        self.total_round_trip = 0.0
+        self.max_round_trip = 0.0
+
+    def link_stats(self):
+        '''
+        acknowledgement loss and round trip time as seen from this side, since the handshake
+        '''
+        if not self.acks_requested:
+            return 'no acknowledgements requested'
+        requested = self.acks_requested
+        lost = requested - self.acks_received
+        if self.acks_received:
+            mean = self.total_round_trip / self.acks_received
+            round_trip = f'round trip mean {mean*1000:.1f} ms max {self.max_round_trip*1000:.1f} ms'
+        else:
+            round_trip = 'no round trips measured'
+        tracker = self.ack_tracker
+        return (f'{lost} of {requested} acknowledgements missing, {tracker.reordered} out of order, '
+                f'{tracker.duplicates} duplicated, {round_trip}')
+
+    def metrics(self):
+        labels = {'box': self.name}
+        yield 'holidayshows_relay_states_sent_total', labels, self.counter
+        yield 'holidayshows_relay_states_suppressed_total', labels, self.suppressed
+        if self.extended:
+            yield 'holidayshows_relay_acks_requested_total', labels, self.acks_requested
+            yield 'holidayshows_relay_acks_received_total', labels, self.acks_received
+            yield 'holidayshows_relay_acks_reordered_total', labels, self.ack_tracker.reordered
+            yield 'holidayshows_relay_acks_duplicated_total', labels, self.ack_tracker.duplicates
+            yield 'holidayshows_relay_round_trip_seconds_sum', labels, self.total_round_trip
+            yield 'holidayshows_relay_round_trip_max_seconds', labels, self.max_round_trip
 
     def get_frames(self):
-        self._socket.sendto(bytes.fromhex('CC0000'), (self.ip, self.port))
+        with self._socket_lock:
+            self._socket.sendto(bytes.fromhex('CC0000'), (self.ip, self.port))
 
-        self._socket.settimeout(1)
-        msg, (returnIP, returnPort) = self._socket.recvfrom(3)
+            self._socket.settimeout(1)
+            while True:
+                msg, (returnIP, returnPort) = self._socket.recvfrom(MAX_PACKET)
+                if msg[0] != 0xEF:
+                    break
+                self.dispatch_ack(msg, returnIP)  # a late acknowledgement, not the answer
         if returnIP != self.ip:
             raise RelayClientException(f'Got frame response from {returnIP}, expected {self.ip}')
         if msg[0] != 0xCC:
@@ -73,25 +250,50 @@ class RelayRemote(dict):
     def __str__(self):
         return self.name
 
-    def show(self):
-        if not self: return ''
-
-        state = 0xDD0000
+    def bits(self):
+        '''
+        16 bit state of the relay values, as sent to the box
+        '''
+        state = 0
         for relay in self.values():
             if relay.value != self.invert:
                 state |= (1 << relay.index)
-            else:
-                state &= ~(1 << relay.index)
+        return state
 
-        self._socket.sendto(state.to_bytes(3, byteorder='big'), (self.ip, self.port))
-        self.counter += 1
+    def show(self, force=False):
+        if not self: return ''
+        return self.send_state(self.bits(), force)
+
+    def send_state(self, bits, force=False):
+        '''
+        sends a 16 bit state, unless it is unchanged and was sent within the keepalive time
+        '''
+        state = 0xDD0000 | bits
+        now = time.time()
+        if force or state != self.last_state or now - self.last_sent >= self.keepalive:
+            if self.extended:
+                self.sequence += 1
+                flags = 0
+                if not self.sequence % ACK_EVERY:
+                    flags |= ACK_REQUESTED
+                    self.acks_requested += 1
+                    self.start_ack_receiver()
+                packet = EXTENDED_STATE.pack(0xEE, bits, self.sequence & 0xFFFFFFFF, now, flags)
+                self._socket.sendto(packet, (self.ip, self.port))
+            else:
+                self._socket.sendto(state.to_bytes(3, byteorder='big'), (self.ip, self.port))
+            self.counter += 1
+            self.last_state = state
+            self.last_sent = now
+        else:
+            self.suppressed += 1
         binary = bin(state)
         return binary[-16:].replace("0", ".").replace("1", "|")
 
     def all(self, value):
         for relay in self.values():
             relay.value = value
-        self.show()
+        self.show(force=True)
 
 class Relay(object):
     def __init__(self, remote, name, index):
@@ -109,6 +311,13 @@ class Relay(object):
             self._timings[value] -= now
             self.value = value
 
+    def credit_on_time(self, seconds):
+        '''
+        for a relay that was left off while a timeline drove it, counts some of that time as on
+        '''
+        self._timings[True] += seconds
+        self._timings[False] -= seconds
+
     @property
     def time_on(self):
         now = time.time()
@@ -122,6 +331,92 @@ class Relay(object):
         else:
             return math.nan
 
+def compile_timeline(relay_rows, relay_order, relays):
+    '''
+    packs relay image rows (frames, len(relay_order)) of booleans into one 16 bit state per frame
+    for each box with a relay in relay_order. returns a list of (remote, mask, states), where mask
+    has the bits of the relays the timeline drives. other bits in states are 0
+    '''
+    relay_rows = np.asarray(relay_rows, dtype=bool)
+    remotes = {}
+    columns = defaultdict(lambda: np.zeros((len(relay_rows), 16), dtype=bool))
+    masks = defaultdict(int)
+    for x, name in enumerate(relay_order):
+        relay = relays[name]
+        remotes[relay.remote.name] = relay.remote
+        columns[relay.remote.name][:, relay.index] = relay_rows[:, x]
+        masks[relay.remote.name] |= 1 << relay.index
+    timeline = []
+    for name, remote in remotes.items():
+        states = np.packbits(columns[name], axis=1, bitorder='little').view('<u2')[:, 0]
+        if remote.invert:
+            states = states ^ masks[name]
+        timeline.append((remote, masks[name], states.astype(np.uint16)))
+    return timeline
+
+def cycle_events(relay_order, timing, start, end, fade_in, fade_out):
+    '''
+    all but one relay on, with the one that is off moving along every `timing` seconds.
+    relay i joins in i/n of the way through fade_in, and drops out i/n of fade_out before the end.
+    yields (time, name, on) for each relay whenever it changes
+    '''
+    count = len(relay_order)
+    generators = []
+    for i, name in enumerate(relay_order):
+        on_from = start + fade_in * i / count
+        off_from = end - fade_out * i / count
+        generators.append(_cycle_relay(name, i, count, timing, start, on_from, off_from))
+    return heapq.merge(*generators)
+
+def _cycle_relay(name, i, count, timing, start, on_from, off_from):
+    if count < 2 or on_from >= off_from:
+        return  # never on
+    on = False
+    slot = int((on_from - start) // timing)
+    t = on_from
+    while t < off_from:
+        # the relay is off during every slot where slot % count == i
+        if (slot % count != i) != on:
+            on = not on
+            yield t, name, on
+        # skip straight to the next slot where it changes
+        slot += (i - slot) % count if on else 1
+        t = start + slot * timing
+    if on:
+        yield off_from, name, False
+
+def random_events(relay_order, timing, duty_cycle, start, end):
+    '''
+    each relay turns on and off at random, cycling in about `timing` seconds and on for about
+    `duty_cycle` of it. a relay stays off rather than turn on for less than its full time before the end
+    '''
+    return heapq.merge(*(_random_relay(name, timing, duty_cycle, start, end) for name in relay_order))
+
+def _random_relay(name, timing, duty_cycle, start, end):
+    t = start + uniform(0, 1.5) * timing * (1 - duty_cycle)
+    while True:
+        on_for = uniform(0.5, 1.5) * timing * duty_cycle
+        if t + on_for > end:
+            print(name, 'staying off')
+            return
+        yield t, name, True
+        t += on_for
+        yield t, name, False
+        t += uniform(0.5, 1.5) * timing * (1 - duty_cycle)
+
+class RelayEvents(object):
+    '''
+    time ordered (time, name, on) events, handed out as they come due
+    '''
+    def __init__(self, events):
+        self.events = events
+        self.upcoming = next(self.events, None)
+
+    def due(self, now):
+        while self.upcoming is not None and self.upcoming[0] <= now:
+            yield self.upcoming
+            self.upcoming = next(self.events, None)
+
 if __name__ == '__main__':
     boxes = []
     message = 'Add box host name: '
@@ -141,7 +436,7 @@ if __name__ == '__main__':
                 for box in boxes:
                     for relay in range(16):
                         box[relay].set(on)
-                        print(f'{box}: {box.show()}')
+                        print(f'{box}: {box.show(force=True)}')
                         time.sleep(delay)
             for box in boxes:
                 try:
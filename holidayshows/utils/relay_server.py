@@ -1,12 +1,24 @@
 #! /usr/bin/env python3
 
+import select
 import socket
 import time
 
 from RPi import GPIO
 GPIO.setmode(GPIO.BCM)
 
-from . import my_ip
+from . import metrics, my_ip, relay
+
+metrics.describe('holidayshows_relay_server_states_total', 'counter', 'Relay states received')
+metrics.describe('holidayshows_relay_server_pin_writes_total', 'counter', 'Relay states written to the pins')
+metrics.describe('holidayshows_relay_server_packets_received_total', 'counter', 'Extended relay packets received from each sender')
+metrics.describe('holidayshows_relay_server_packets_lost_total', 'counter', 'Extended relay packets from each sender that never arrived')
+metrics.describe('holidayshows_relay_server_packets_reordered_total', 'counter', 'Extended relay packets from each sender that arrived out of order')
+metrics.describe('holidayshows_relay_server_packets_duplicated_total', 'counter', 'Extended relay packets from each sender received more than once')
+metrics.describe('holidayshows_relay_server_stale_states', 'gauge', 'States replaced before being written, since the last frame query')
+metrics.describe('holidayshows_relay_server_queue_depth_max', 'gauge', 'Most packets handled at once, since the last frame query')
+metrics.describe('holidayshows_relay_server_latency_max_seconds', 'gauge', 'Longest time from a packet arriving to the pins being written, since the last frame query')
+metrics.describe('holidayshows_relay_on', 'gauge', 'Whether each relay is on')
 
 class RelayServer():
     def __init__(self):
@@ -14,8 +26,15 @@ class RelayServer():
         HOST, PORT = my_ip.MY_IP, 2700
         print(f'Serving on {HOST}:{PORT}')
         self.socket.bind((HOST, PORT))
+        self.socket.setblocking(False)
         self.counter = 0
+        self.states = 0
+        self.pin_writes = 0
+        self.pending_state = None
+        self.senders = {}  # sequence tracking for each address sending extended packets
+        self.reset_stats()
         self.setup_relays()
+        metrics.register(self.metrics)
         try:
             print('server is running')
             self.listen_forever()
@@ -31,52 +50,136 @@ class RelayServer():
             6, 13, 19, 26, 12, 16, 20, 21
         ]
         self.relay_values = [False] * len(self.relay_pins)
+        self.pin_values = [None] * len(self.relay_pins)  # what was last written to each pin
         GPIO.setup(self.relay_pins, GPIO.OUT)
 
+    def reset_stats(self):
+        self.batches = 0
+        self.max_queue_depth = 0
+        self.total_queue_depth = 0
+        self.stale_states = 0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
     def listen_forever(self):
+        '''
+        waits for packets, then handles everything that has queued up.
+        only the newest relay state in each batch is written to the pins
+        '''
         while True:
-            message, address = self.socket.recvfrom(3)
-            response = self.handle(message)
-            if response:
-                self.socket.sendto(response, address)
-            time.sleep(0.01)
+            select.select([self.socket], [], [])
+            arrived = time.time()
+            depth = 0
+            while True:
+                try:
+                    message, address = self.socket.recvfrom(relay.MAX_PACKET)
+                except BlockingIOError:
+                    break
+                depth += 1
+                response = self.handle(message, address)
+                if response:
+                    self.socket.sendto(response, address)
+            if self.pending_state is not None:
+                self.apply_state(self.pending_state)
+                self.pending_state = None
+            latency = time.time() - arrived
+            self.batches += 1
+            self.total_queue_depth += depth
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def metrics(self):
+        yield 'holidayshows_relay_server_states_total', {}, self.states
+        yield 'holidayshows_relay_server_pin_writes_total', {}, self.pin_writes
+        for (host, port), tracker in list(self.senders.items()):
+            labels = {'sender': f'{host}:{port}'}
+            yield 'holidayshows_relay_server_packets_received_total', labels, tracker.received
+            yield 'holidayshows_relay_server_packets_lost_total', labels, tracker.lost
+            yield 'holidayshows_relay_server_packets_reordered_total', labels, tracker.reordered
+            yield 'holidayshows_relay_server_packets_duplicated_total', labels, tracker.duplicates
+        yield 'holidayshows_relay_server_stale_states', {}, self.stale_states
+        yield 'holidayshows_relay_server_queue_depth_max', {}, self.max_queue_depth
+        yield 'holidayshows_relay_server_latency_max_seconds', {}, self.max_latency
+        for index, value in enumerate(list(self.relay_values)):
+            yield 'holidayshows_relay_on', {'relay': index}, value
+
+    def print_stats(self):
+        if not self.batches: return
+        print(f'queue depth mean {self.total_queue_depth / self.batches:.2f} max {self.max_queue_depth}, '
+              f'{self.stale_states} stale states skipped, '
+              f'latency mean {self.total_latency / self.batches * 1000:.2f} ms max {self.max_latency * 1000:.2f} ms')
+        for address, tracker in self.senders.items():
+            print(f'{address[0]}:{address[1]}: {tracker}')
 
-    def handle(self, message: bytes) -> bytes:
+    def handle(self, message: bytes, address) -> bytes:
         if message[0] == 0xAA:
             # handshake
             print('handshake')
+            if int.from_bytes(message[1:3], 'big') == relay.EXTENDED_HANDSHAKE:
+                self.senders[address] = relay.SequenceTracker()
+                return 0xBB.to_bytes(1, 'big') + relay.EXTENDED_VERSION.to_bytes(2, 'big')
             return 0xBB.to_bytes(1, 'big') + message[1:3]
 
         elif message[0] == 0xCC:
             # counter query
             response = 0xCC.to_bytes(1, 'big') + (self.counter % 65536).to_bytes(2, 'big')
             print(f'have received {self.counter} frames')
+            self.print_stats()
             self.counter = 0
+            self.reset_stats()
             return response
 
         elif message[0] == 0xDD:
-            # set relays
-            relay_values = int.from_bytes(message[1:3], "big")
-            for i in range(16):
-                self.relay_values[i] = bool(relay_values & 2**i)
-            self.show_relays()
+            # set relays, once the rest of the queue has been read
+            if self.pending_state is not None:
+                self.stale_states += 1
+            self.pending_state = int.from_bytes(message[1:3], "big")
             self.counter += 1
+            self.states += 1
+
+        elif message[0] == 0xEE and len(message) == relay.EXTENDED_STATE.size:
+            # set relays, with a sequence number
+            _, relay_values, sequence, sent, flags = relay.EXTENDED_STATE.unpack(message)
+            self.counter += 1
+            self.states += 1
+            tracker = self.senders.setdefault(address, relay.SequenceTracker())
+            if tracker.track(sequence):
+                if self.pending_state is not None:
+                    self.stale_states += 1
+                self.pending_state = relay_values
+            else:
+                self.stale_states += 1
+            if flags & relay.ACK_REQUESTED:
+                return relay.ACK.pack(0xEF, sequence, sent)
 
         else:
             print(f'unhandled message {message}')
 
         return b''
 
+    def apply_state(self, relay_values):
+        for i in range(16):
+            self.relay_values[i] = bool(relay_values & 2**i)
+        self.show_relays()
+
     def show_relays(self):
+        '''
+        writes only the pins whose value changed
+        '''
         relays_on = []
         relays_off = []
         for index, value in enumerate(self.relay_values):
             pin = self.relay_pins[index]
             if pin is None: continue
+            if value == self.pin_values[index]: continue
+            self.pin_values[index] = value
             if value:
                 relays_on.append(pin)
             else:
                 relays_off.append(pin)
+        if relays_on or relays_off:
+            self.pin_writes += 1
         if relays_on:
             GPIO.output(relays_on, 1)
         if relays_off:
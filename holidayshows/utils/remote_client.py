@@ -1,15 +1,20 @@
 from enum import IntEnum
-import json
+from itertools import count
+import select
+import threading
 import time
 import socket
-import struct
 
-from . import my_ip, players
+from . import clock_sync, my_ip, players, protocol
 
 ALLOW_ERRORS = False
+HEARTBEAT_SECONDS = 60  # ping a session before using it if it has been idle this long
+HEARTBEAT_TIMEOUT = 5
+KEEP_ALIVE_SECONDS = 1  # how often remotes that are playing are looked in on
+FINISHED_POLL_SECONDS = 0.1  # how often the scheduler checks whether the remotes have finished
 
 class Remote_Client:
-    def __init__(self, name, config):
+    def __init__(self, name, config, sets_clock=True):
         self.name = name
         config = config
         print('configuring client for', name)
@@ -22,37 +27,68 @@ class Remote_Client:
             self.players = players.Players()
         self.players_added = False
         self.connected = False
+        self.request_ids = count(1)
+        self.deferred = set()  # ids of responses still owed by the remote, e.g. a song that is playing
+        self.arrived = {}  # deferred responses read while waiting for another
+        self.synchronizing = False
+        self.last_contact = 0
+        self.clock = clock_sync.Clock_Sync()
+        self.sets_clock = sets_clock
+        self.loader = None
+        self.last_frame_timing = None  # sent back by the remote when a song finishes
 
     def __del__(self):
         self.disconnect()
 
     def synchronize(self):
         '''
-        sends time to remote and gets time back. offset is stored on remote, but printed here too
+        measures the remote clock over several round trips, keeps the one with the shortest
+        round trip, and sends the resulting offset and drift to the remote, which applies them
         '''
         assert self.connected
+        if self.synchronizing:
+            return  # its requests heartbeat too, which could otherwise start another
         if self.ip:
-            client_time = time.time()
-            response = self.send(function='synchronize', arguments={'master_time': client_time})
-            server_time = response['response']
-            self.time_offset = server_time - client_time
-            if abs(self.time_offset) > .03:
-                print()
-                print()
-                print()
-                print(f'{self.name}: warning, large time offset: {self.time_offset:.04f}')
-                print()
-                print()
-                print()
-            # else:
-            #     print(f'{self.name}: time offset:', self.time_offset)
+            self.synchronizing = True
+            try:
+                self.measure_clock()
+            finally:
+                self.synchronizing = False
         else:
             self.time_offset = 0
 
+    def measure_clock(self):
+        '''
+        one synchronization: the round trips, and the set_clock that sends the result
+        '''
+        samples = []
+        for _ in range(clock_sync.SAMPLES):
+            sent = time.time()
+            response = self.send(function='synchronize', arguments={'master_time': sent})
+            received = time.time()
+            samples.append((sent, received, response['response']))
+        master_time, offset, round_trip = clock_sync.best_sample(samples)
+        self.clock.update(master_time, offset)
+        self.send(function='set_clock', arguments=self.clock.state(), expected_response={'response': 'success'})
+        self.time_offset = offset
+        if abs(self.time_offset) > .03:
+            print()
+            print()
+            print()
+            print(f'{self.name}: warning, large time offset: {self.time_offset:.04f}')
+            print()
+            print()
+            print()
+        print(f'{self.name}: time offset {offset:.04f}, round trip {round_trip:.04f}, drift {self.clock.drift * 1e6:.1f} ppm')
+
     def connect(self):
         if self.ip:
             print(f'connecting to {self.name} at {self.ip}:{self.port}')
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            protocol.configure(self.socket)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self.deferred.clear()
+            self.arrived.clear()
             try:
                 self.socket.connect((self.ip, self.port))
             except (ConnectionRefusedError, socket.gaierror, OSError) as e:
@@ -63,15 +99,66 @@ class Remote_Client:
             else:
                 print(f'connected to {self.name}')
                 self.connected = True
-                self.synchronize()
+                self.last_contact = time.time()
+                if self.sets_clock:
+                    self.synchronize()
         else:
             print(f'server runs locally')
 
     def disconnect(self):
+        if self.loader is not None:
+            self.loader.disconnect()
+        if self.connected:
+            print(f'{self.name}: disconnect')
+            try:
+                protocol.send_frame(self.socket, protocol.NOTIFY, {'function': 'disconnect', 'arguments': None})
+            except OSError:
+                pass
+            self.reset()
+
+    def reset(self):
+        '''
+        drops the session without talking to the remote
+        '''
         if self.connected:
-            self.send(function='disconnect', arguments=None, expected_response=False)
             self.socket.close()
-            self.connected = False
+        self.connected = False
+        self.deferred.clear()
+        self.arrived.clear()
+
+    def reconnect(self):
+        print(f'{self.name}: reconnecting')
+        self.reset()
+        self.connect()
+
+    def resync(self):
+        '''
+        synchronizes the clock again while a song plays, once it has gone stale. the remote
+        answers even while it plays, so a song that plays for hours stays in time. only the
+        keep-alive thread calls this, so the round trips never hold up a frame
+        '''
+        if self.connected and self.deferred and self.clock.stale and self.sets_clock and not self.synchronizing:
+            print(f'{self.name}: synchronizing while playing')
+            self.synchronize()
+
+    def heartbeat(self):
+        '''
+        pings an idle session, reconnecting if the remote does not answer
+        '''
+        if not self.connected:
+            return
+        if time.time() - self.last_contact < HEARTBEAT_SECONDS:
+            return
+        self.socket.settimeout(HEARTBEAT_TIMEOUT)
+        try:
+            request_id = next(self.request_ids)
+            protocol.send_frame(self.socket, protocol.REQUEST, {'function': 'ping', 'arguments': None}, request_id)
+            self.get_response(request_id)
+        except (OSError, ValueError) as e:
+            print(f'{self.name}: heartbeat failed: {e}')
+            self.reconnect()
+        else:
+            self.socket.settimeout(None)
 
     def play(self, index, repeat, end_by, epoch, fps):
         '''
@@ -83,41 +170,217 @@ class Remote_Client:
             yield from self.players.play_all(arguments)
         else:
             if self.players_added:
-                self.send(function='play', arguments=arguments, expected_response=False)
-                self.disconnect()
+                self.collect()
+                if self.clock.stale:
+                    self.synchronize()
+                self.send(function='play', arguments=arguments, deferred=True)
+                late = time.time() - epoch
+                if late > 0:
+                    # a synchronize or reconnect took longer than the lead, so the remote starts late
+                    print(f'{self.name}: warning, play sent {late:.3f} seconds after the song should have started')
     
-    def get_response(self):
+    def play_live(self, end_by, fps=None):
+        '''
+        shows rows streamed to this remote's strip until end_by
+        '''
+        arguments = {'live': True, 'end_by': end_by, 'fps': fps}
+        if self.local:
+            yield from self.players.play_all(arguments)
+        else:
+            if self.players_added:
+                self.collect()
+                if self.clock.stale:
+                    self.synchronize()
+                self.send(function='play', arguments=arguments, deferred=True)
+
+    def get_response(self, request_id):
+        '''
+        reads until the response to request_id, keeping any deferred ones that come first
+        '''
         if not self.local:
-            return self.socket.recv(1024)
+            while request_id not in self.arrived:
+                self.read_response(request_id)
+            kind, response = self.arrived.pop(request_id)
+            if kind == protocol.ERROR:
+                raise protocol.RemoteError(f'{self.name}: {response}')
+            return response
+
+    def read_response(self, request_id=None):
+        kind, response_id, response = protocol.recv_frame(self.socket)
+        if kind is None:
+            raise ValueError(f'no response from {self.name}. possible error on remote')
+        self.last_contact = time.time()
+        if response_id == request_id or response_id in self.deferred:
+            self.arrived[response_id] = kind, response
+        else:
+            print(f'{self.name}: ignoring response to unknown request {response_id}')
 
-    def send(self, function, arguments, expected_response=None):
+    def playing(self):
+        '''
+        whether a song sent to the remote is still playing, reading any responses
+        that have already arrived without waiting for more
+        '''
+        if not self.connected:
+            return False
+        while self.deferred - set(self.arrived) and select.select([self.socket], [], [], 0)[0]:
+            self.read_response()
+        return bool(self.deferred - set(self.arrived))
+
+    def collect(self):
+        '''
+        waits for any deferred responses, such as a song finishing on the remote
+        '''
+        while self.deferred:
+            request_id = min(self.deferred)
+            self.deferred.discard(request_id)
+            response = self.get_response(request_id)
+            if isinstance(response, dict) and response.get('frame_timing'):
+                self.last_frame_timing = response['frame_timing']
+
+    def send(self, function, arguments, expected_response=None, deferred=False):
+        '''
+        with expected_response=False, the remote is told not to reply at all
+        with deferred=True, the reply is left for collect(), and other requests can be
+        made meanwhile, e.g. loading the next song while this one plays
+        '''
         if not self.connected:
             self.connect()
-        data = json.dumps({'function': function, 'arguments': arguments}).encode()
         print(f'{self.name}: {function}')
-        data = struct.pack('Q', len(data)) + data
         if self.connected:
-            self.socket.sendall(data)
-            time.sleep(0.1)
+            self.heartbeat()
+            kind = protocol.NOTIFY if expected_response == False else protocol.REQUEST
+            message = {'function': function, 'arguments': arguments}
+            request_id = next(self.request_ids)
+            try:
+                protocol.send_frame(self.socket, kind, message, request_id)
+            except OSError as e:
+                print(f'{self.name}: connection lost: {e}')
+                self.reconnect()
+                protocol.send_frame(self.socket, kind, message, request_id)
             if expected_response == False:
                 return
-            response = self.socket.recv(1024).decode()
-            if not response:
-                raise ValueError(f'no response from {self.name}. possible error on remote')
-            response = json.loads(response)
+            if deferred:
+                self.deferred.add(request_id)
+                return
+            response = self.get_response(request_id)
             if expected_response is not None and response != expected_response:
                 raise ValueError(f'server ({self.name}) expected {expected_response} got {response}')
             return response
 
+    def frame_timing(self):
+        '''
+        frame timing summaries of the latest songs played on this remote's strips,
+        once the song playing has finished
+        '''
+        if self.local:
+            return self.players.frame_timing()
+        self.collect()
+        return self.send(function='frame_timing', arguments=None)['response']
+
+    def status(self):
+        '''
+        what the remote is playing and which songs it has loaded, answered even while it plays
+        '''
+        if self.local:
+            return {'playing': None, 'loaded': self.players.loaded(), 'loading': 0, 'connections': 0}
+        return self.send(function='status', arguments=None)['response']
+
+    def stop(self):
+        '''
+        ends the song playing on the remote early. a local song is played by the caller's own schedule
+        '''
+        if self.connected and not self.local:
+            self.send(function='stop', arguments=None)
+            self.collect()
+
     def load_data(self, kind, data):
         if self.local:
             self.players.load_data(kind, data)
         else:
             self.send(function='load_data', arguments={'kind': int(kind), 'data': data})
 
+    def unload(self, kind, index):
+        '''
+        frees a song the remote has played, and won't play again until it's loaded again
+        '''
+        if self.local:
+            self.players.unload(kind, index)
+        else:
+            self.send(function='unload', arguments={'kind': int(kind), 'index': index})
+
+    def loading_session(self):
+        '''
+        a second session to the same remote, so songs can be loaded from another thread
+        while this session plays. it leaves the remote's clock to this one
+        '''
+        if self.local:
+            return self
+        if self.loader is None:
+            self.loader = Remote_Client(self.name, {'host': self.ip, 'port': self.port}, sets_clock=False)
+        return self.loader
+
     def add_player(self, kind, player_globals):
         if self.local:
             self.players.add(kind, player_globals)
         else:
             self.players_added = True
             self.send(function='add_player', arguments={'kind':int(kind), 'player_globals': player_globals})
+
+class Remote_Pool(dict):
+    '''
+    long-lived sessions to every remote, by name
+    '''
+    def heartbeat(self):
+        for client in self.values():
+            client.heartbeat()
+
+    def synchronize_stale(self):
+        '''
+        synchronizes every remote whose clock has gone stale, ahead of a play
+        '''
+        for client in self.values():
+            if not client.local and client.players_added and client.clock.stale:
+                client.collect()
+                client.synchronize()
+
+    def keep_alive(self, clock=time.time):
+        '''
+        for a scheduler while songs play: waits until every remote has finished, while a
+        thread of its own heartbeats them and keeps their clocks synchronized. a remote that is slow to answer, or gone, then
+        never holds up the frames the scheduler is showing
+        '''
+        finished = threading.Event()
+        watcher = threading.Thread(target=self.watch, args=(finished,), name='keep-alive', daemon=True)
+        watcher.start()
+        try:
+            while not finished.is_set():
+                yield clock() + FINISHED_POLL_SECONDS
+        finally:
+            finished.set()
+            watcher.join()  # the sessions are the caller's again once this returns
+
+    def watch(self, finished):
+        '''
+        the keep-alive thread: heartbeats every remote still playing, and synchronizes any
+        whose clock has gone stale, until none is playing or finished is set. a remote that
+        fails is dropped, and counts as finished
+        '''
+        while not finished.is_set():
+            playing = []
+            for client in self.values():
+                try:
+                    if client.playing():
+                        playing.append(client)
+                        client.heartbeat()
+                        client.resync()
+                except (OSError, ValueError, protocol.RemoteError) as e:
+                    print(f'{client.name}: keep alive failed: {e}')
+                    client.reset()
+            if not playing:
+                break
+            finished.wait(KEEP_ALIVE_SECONDS)
+        finished.set()
+
+    def close(self):
+        for client in self.values():
+            client.disconnect()
@@ -1,104 +1,214 @@
-import json
-import socket
-import struct
+import asyncio
+import threading
 import time
+import traceback
 
-from . import my_ip, players
+from . import clock_sync, metrics, my_ip, players, protocol, scheduler
 
 class Remote_Server:
+    '''
+    answers any number of connections at once. a song plays on a thread of its own, and is
+    answered when it ends, so status, stop, load_data (for the next song), synchronize and
+    metrics are all answered while it plays
+    '''
     def __init__(self, HOST, PORT):
         print(f'Serving on {HOST}:{PORT}')
+        self.host = HOST
+        self.port = PORT
         self.delay = 0
-        self.time_offset = 0
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind((HOST, PORT))
+        self.clock = clock_sync.Clock_Sync()
         self.players = players.Players()
+        self.connections = 0
+        self.tasks = set()  # songs being played, kept until they're answered
+        self.playing = None  # the arguments of the song playing
+        self.play_future = None
+        self.stopping = threading.Event()
+        self.loads = 0
+        metrics.register(self.metrics)
+        metrics.register(metrics.collect_image_cache)
         try:
-            while True:
-                self.listen()
+            asyncio.run(self.serve())
         except KeyboardInterrupt:
             pass
         finally:
-            self.sock.close()
             for player in self.players.values():
                 player.stop()
             print('Remote Server closed')
 
-    def listen(self):
-        self.sock.listen(1)
-        print('waiting for connection')
-        conn, addr = self.sock.accept()
-        print('accepted connection from', addr)
-        while 1:
-            print(f'command...', end=' ', flush=True)
-            message = b''
-            while len(message) < 8:
-                message += conn.recv(8 - len(message))
-            message_length = struct.unpack('Q', message)[0]
-            message = b''
-            while len(message) < message_length:
-                message += conn.recv(message_length - len(message))
-            response = self.handle(message)
-            if response:
-                response_bytes = json.dumps(response).encode()
-                conn.sendall(response_bytes)
-            else:
-                break
-        conn.close()
-        print('connection closed')
-
-    def handle(self, data):
-        data = json.loads(data)
+    async def serve(self):
+        # players are only changed by one load at a time, however many connections ask
+        self.changing = asyncio.Lock()
+        server = await asyncio.start_server(self.connection, self.host, self.port, reuse_address=True)
+        try:
+            async with server:
+                print('waiting for connections')
+                await server.serve_forever()
+        finally:
+            self.stopping.set()  # or the song's thread would hold up the exit
+
+    async def connection(self, reader, writer):
+        protocol.configure(writer.get_extra_info('socket'))
+        address = writer.get_extra_info('peername')
+        print('accepted connection from', address)
+        self.connections += 1
+        try:
+            while True:
+                kind, request_id, message = await protocol.read_frame(reader)
+                if kind is None or message['function'] == 'disconnect':
+                    break
+                print(f'command... {message["function"]}')
+                if message['function'] == 'play':
+                    task = asyncio.create_task(self.respond(writer, kind, request_id, message))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                else:
+                    await self.respond(writer, kind, request_id, message)
+        except (ConnectionError, protocol.ProtocolError) as e:
+            print(f'connection from {address} failed: {e}')
+        finally:
+            self.connections -= 1
+            writer.close()
+            print('connection closed', address)
+
+    async def respond(self, writer, kind, request_id, message):
+        try:
+            response = await self.handle(message)
+            reply = protocol.RESPONSE
+        except Exception as e:
+            traceback.print_exc()
+            response = f'{type(e).__name__}: {e}'
+            reply = protocol.ERROR
+        if kind != protocol.REQUEST or writer.is_closing():
+            return  # not wanted, or whoever asked has gone
+        writer.writelines(protocol.encode_frame(reply, response, request_id))
+        try:
+            await writer.drain()
+        except ConnectionError as e:
+            print(f'response to {message["function"]} not sent: {e}')
+
+    async def handle(self, data):
         handlers = {
             'synchronize': self.synchronize,
+            'set_clock': self.set_clock,
+            'ping': self.ping,
+            'status': self.status,
+            'frame_timing': self.frame_timing,
+            'metrics': self.metrics_text,
             'play': self.play,
+            'stop': self.stop,
             'add_player': self.add_player,
-            'disconnect': None,
-            'load_data': self.load_data
+            'load_data': self.load_data,
+            'unload': self.unload
         }
-        print(data['function'])
         handler = handlers[data['function']]
-        if handler:
-            return handler(data['arguments'])
+        response = handler(data['arguments'])
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
 
     def synchronize(self, arguments):
-        master_time = arguments['master_time']
-        my_time = time.time()
-        self.time_offset = my_time - master_time
-        return {'response': my_time}
+        return {'response': time.time()}
+
+    def set_clock(self, arguments):
+        self.clock.load(arguments)
+        return {'response': 'success'}
+
+    def ping(self, arguments):
+        return {'response': 'pong'}
 
-    def play(self, arguments):
+    def status(self, arguments):
+        return {'response': {
+            'playing': self.playing,
+            'loaded': self.players.loaded(),
+            'loading': self.loads,
+            'connections': self.connections,
+        }}
+
+    async def play(self, arguments):
         required_arguments = 'index', 'epoch', 'repeat', 'end_by', 'fps'
+        if arguments.get('live'):
+            required_arguments = 'end_by',
         for key in required_arguments:
             if key not in arguments:
                 raise KeyError(key)
-        arguments['epoch'] += self.time_offset
-        arguments['end_by'] += self.time_offset
+        if self.playing is not None:
+            raise RuntimeError(f'already playing {self.playing}')
         print('\n'*2)
         print('received play request:', arguments)
         print('\n'*2)
-        player = self.players.play_all(arguments)
+        self.playing = dict(arguments)
+        self.stopping.clear()
+        # epoch and end_by stay in master time, and players read the master's clock
+        arguments['clock'] = self.clock.master_time
+        self.play_future = asyncio.get_running_loop().run_in_executor(None, self.run_play, arguments)
         try:
-            while True:
-                message = next(player)
-                # print('\r', str(message).ljust(50), end='')
-        except StopIteration:
-            pass
+            await self.play_future
+        finally:
+            self.playing = None
+        latest = self.players.frame_timing()[-1:]
+        response = 'stopped' if self.stopping.is_set() else 'complete'
+        return {'response': response, 'frame_timing': latest[0] if latest else None}
+
+    def run_play(self, arguments):
+        schedule = scheduler.Scheduler(self.clock.master_time)
+        schedule.add(scheduler.stoppable(self.players.play_all(arguments), self.stopping, self.clock.master_time))
+        schedule.run()
+
+    async def stop(self, arguments):
+        '''
+        ends the song playing, answering once it has
+        '''
+        if self.playing is None:
+            return {'response': 'not playing'}
+        self.stopping.set()
+        self.players.abort()
+        await asyncio.wait([self.play_future])
+        return {'response': 'stopped'}
+
+    def frame_timing(self, arguments):
+        return {'response': self.players.frame_timing()}
 
-    def add_player(self, arguments):
+    def metrics_text(self, arguments):
+        return {'response': metrics.render()}
+
+    def metrics(self):
+        yield from self.clock.metrics()
+        yield from self.players.metrics()
+
+    async def add_player(self, arguments):
         kind = arguments['kind']
         player_kind = players.PLAYER_KINDS(kind)
         player_globals = arguments['player_globals']
-
-        self.players.add(player_kind, player_globals)
+        if self.playing is not None:
+            raise RuntimeError('players can only be added between songs')
+        async with self.changing:
+            await asyncio.get_running_loop().run_in_executor(None, self.players.add, player_kind, player_globals)
         return {'response': 'success'}
 
-    def load_data(self, arguments):
+    async def load_data(self, arguments):
         kind = arguments['kind']
         player_kind = players.PLAYER_KINDS(kind)
         data = arguments['data']
-        self.players.load_data(player_kind, data)
+        if self.playing is not None and data.get('index') == self.playing.get('index'):
+            raise RuntimeError(f'song {data["index"]} is playing')
+        self.loads += 1
+        try:
+            async with self.changing:
+                start = time.time()
+                # slicing takes a while, so it runs on a thread and the other connections are still answered
+                await asyncio.get_running_loop().run_in_executor(None, self.players.load_data, player_kind, data)
+                metrics.set_value('holidayshows_load_seconds', time.time() - start, kind=player_kind.name.lower())
+        finally:
+            self.loads -= 1
+        return {'response': 'success'}
+
+    async def unload(self, arguments):
+        player_kind = players.PLAYER_KINDS(arguments['kind'])
+        index = arguments['index']
+        if self.playing is not None and index == self.playing.get('index'):
+            raise RuntimeError(f'song {index} is playing')
+        async with self.changing:
+            self.players.unload(player_kind, index)
         return {'response': 'success'}
 
 def run_remote():
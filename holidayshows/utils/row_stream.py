@@ -0,0 +1,141 @@
+import glob
+import mmap
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+BLOCK_ROWS = 256  # rows sliced and packed at a time while writing
+READ_AHEAD_ROWS = 64
+# on disk, where /tmp is often kept in memory on a Pi, which would defeat streaming
+STREAM_DIRECTORY = '/var/tmp'
+PREFIX = 'holidayshows-'
+
+def make_directory(parent=None):
+    '''
+    a directory for this process's stream files, named for its pid so a later process can
+    tell whether it was left behind
+    '''
+    parent = parent or STREAM_DIRECTORY
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(prefix=f'{PREFIX}{os.getpid()}-', dir=parent)
+
+def remove_stale_directories(parent=None):
+    '''
+    removes stream directories left by processes that died mid-show
+    '''
+    for path in glob.glob(os.path.join(parent or STREAM_DIRECTORY, PREFIX + '*')):
+        try:
+            pid = int(os.path.basename(path)[len(PREFIX):].split('-')[0])
+        except ValueError:
+            pid = None  # from before directories were named for their process
+        if pid == os.getpid() or (pid is not None and process_running(pid)):
+            continue
+        print(f'removing stale stream directory {path}')
+        shutil.rmtree(path, ignore_errors=True)
+
+def process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # someone else's
+    return True
+
+class Row_Stream:
+    '''
+    packed rows for one song, in a file that is memory mapped read-only.
+    only the rows around the one being shown are kept resident: the next window is
+    requested ahead of time and the previous one is dropped as playback moves on
+    '''
+    def __init__(self, path, height, length):
+        self.path = path
+        self.height = height
+        self.length = length
+        self.row_bytes = length * np.dtype(np.uint32).itemsize
+        with open(path, 'rb') as rows_file:
+            self.mmap = mmap.mmap(rows_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.rows = np.frombuffer(self.mmap, dtype=np.uint32).reshape(height, length)
+        self.window = None
+
+    @classmethod
+    def write(cls, path, length, blocks):
+        '''
+        blocks is an iterable of packed (rows, length) arrays, written in order
+        '''
+        height = 0
+        with open(path, 'wb') as rows_file:
+            for block in blocks:
+                rows_file.write(np.ascontiguousarray(block, dtype=np.uint32).tobytes())
+                height += len(block)
+        if not height or not length:
+            os.remove(path)
+            raise ValueError(f'nothing to stream to {path}: {height} rows of {length} pixels')
+        return cls(path, height, length)
+
+    def __len__(self):
+        return self.height
+
+    def __getitem__(self, y):
+        window = y // READ_AHEAD_ROWS
+        if window != self.window:
+            self.window = window
+            self.advise('MADV_WILLNEED', (window + 1) * READ_AHEAD_ROWS % self.height)
+            if window:
+                self.advise('MADV_DONTNEED', (window - 1) * READ_AHEAD_ROWS)
+        return self.rows[y]
+
+    def advise(self, advice, first_row):
+        advice = getattr(mmap, advice, None)
+        if advice is None or not hasattr(self.mmap, 'madvise'):
+            return
+        start = first_row * self.row_bytes
+        stop = min(first_row + READ_AHEAD_ROWS, self.height) * self.row_bytes
+        start -= start % mmap.PAGESIZE  # madvise needs page aligned offsets
+        if stop > start:
+            self.mmap.madvise(advice, start, stop - start)
+
+    def close(self):
+        self.rows = None
+        try:
+            self.mmap.close()
+        except BufferError:
+            # a row is still referenced somewhere. the mapping goes once that row does,
+            # and the file is removed from under it now regardless
+            pass
+        self.mmap = None
+        os.remove(self.path)
+
+class Side_By_Side:
+    '''
+    one Row_Stream per strip of a strip.Strip_Group, read as rows that run across all of
+    them. strips with nothing streamed for the song stay black
+    '''
+    def __init__(self, group):
+        self.columns = {name: group.columns(name) for name in group.strips}
+        self.row = np.zeros(group.length, dtype=np.uint32)  # reused, since each row is copied on to the strips
+        self.streams = {}
+
+    def add(self, name, stream):
+        self.remove(name)
+        self.streams[name] = stream
+
+    def remove(self, name):
+        stream = self.streams.pop(name, None)
+        if stream is not None:
+            stream.close()
+            self.row[self.columns[name]] = 0
+
+    def __len__(self):
+        return min((len(stream) for stream in self.streams.values()), default=0)
+
+    def __getitem__(self, y):
+        for name, stream in self.streams.items():
+            self.row[self.columns[name]] = stream[y]
+        return self.row
+
+    def close(self):
+        for name in list(self.streams):
+            self.remove(name)
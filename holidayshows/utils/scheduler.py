@@ -0,0 +1,91 @@
+import heapq
+from itertools import count
+import time
+
+SPIN_SECONDS = 0.0005  # sleep until this close to a deadline, then spin the rest of the way
+STOP_CHECK_SECONDS = 0.05  # how often a stoppable generator waiting on a far deadline looks at its event
+
+class Scheduler:
+    '''
+    runs generators that yield the time they next need to run (None for as soon as possible)
+
+    iterating a Scheduler yields the earliest deadline of everything in it, so a scheduler
+    can be added to another one. run() drives it directly, sleeping between deadlines
+    '''
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.queue = []
+        self.order = count()  # breaks ties between equal deadlines without comparing generators
+        self.added = 0
+        self.resumed = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def add(self, generator, deadline=None):
+        if deadline is None:
+            deadline = self.clock()
+        heapq.heappush(self.queue, (deadline, next(self.order), generator))
+        self.added += 1
+
+    def __len__(self):
+        return self.added
+
+    def __iter__(self):
+        while self.queue:
+            deadline, _, generator = self.queue[0]
+            now = self.clock()
+            if deadline > now:
+                yield deadline
+                continue
+            heapq.heappop(self.queue)
+            lateness = now - deadline
+            self.resumed += 1
+            self.total_lateness += lateness
+            self.max_lateness = max(self.max_lateness, lateness)
+            try:
+                next_deadline = next(generator)
+            except StopIteration:
+                continue
+            if next_deadline is None:
+                next_deadline = now
+            heapq.heappush(self.queue, (next_deadline, next(self.order), generator))
+
+    def close(self):
+        '''
+        closes everything still waiting, so their cleanup runs now
+        '''
+        while self.queue:
+            deadline, _, generator = heapq.heappop(self.queue)
+            generator.close()
+
+    def sleep_until(self, deadline):
+        remaining = deadline - self.clock()
+        if remaining > SPIN_SECONDS:
+            time.sleep(remaining - SPIN_SECONDS)
+        while self.clock() < deadline:
+            pass
+
+    def run(self):
+        for deadline in self:
+            self.sleep_until(deadline)
+        self.report()
+
+    def report(self):
+        if self.resumed:
+            mean = self.total_lateness / self.resumed
+            print(f'scheduler: {self.resumed} wakeups, lateness mean {mean*1000:.2f} ms, max {self.max_lateness*1000:.2f} ms')
+
+def stoppable(generator, stop, clock=time.time):
+    '''
+    passes a generator's deadlines through until the threading.Event stop is set, then closes it.
+    a far deadline is waited for in steps, so stopping doesn't wait for it
+    '''
+    try:
+        for deadline in generator:
+            while deadline is not None and deadline - clock() > STOP_CHECK_SECONDS and not stop.is_set():
+                yield clock() + STOP_CHECK_SECONDS
+            if stop.is_set():
+                return
+            yield deadline
+    finally:
+        generator.close()
@@ -1,66 +1,79 @@
+import atexit
 from collections import defaultdict
 import time
 
+import numpy as np
+
+from . import frame_timing
+
 try:
-    from rpi_ws281x import Adafruit_NeoPixel
+    import _rpi_ws281x as ws
 except ImportError:
-    def Adafruit_NeoPixel(*args, **kwargs):
-        raise ImportError('rpi_ws281x not installed')
+    ws = None
     print('rpi_ws281x not installed')
 
 class Blacks:
-    def __init__(self, blacks_prefs):
-        self.ranges = []
+    def __init__(self, blacks_prefs, length):
+        self.length = length
         self.original_ranges = []
         for black in blacks_prefs:
-            self.ranges.append(range(black[0], black[1]))
             self.original_ranges.append(range(black[0], black[1]))
-        self.ranges.sort(key=lambda x:x.start)
+        self.original_ranges.sort(key=lambda x:x.start)
         previous_stop = None
         self.longest_span = 0
-        for black_range in self.ranges:
+        for black_range in self.original_ranges:
             if previous_stop:
                 self.longest_span = max(self.longest_span, black_range.start - previous_stop)
             previous_stop = black_range.stop
         print('longest span:', self.longest_span)
+        self.max_delta = self.longest_span // 2
+        self.delta = None
+        self.scale()
+
+    def build_mask(self, delta):
+        '''
+        the blacks expanded by delta, True to keep a pixel and False to blacken it
+        '''
+        mask = np.ones(self.length, dtype=bool)
+        for black_range in self.original_ranges:
+            start = max(black_range.start - delta, 0)
+            stop = max(black_range.stop + delta, 0)
+            mask[start:stop] = False
+        return mask
 
     def scale(self, x=1):
         '''
         expand the blacks such that at 0 it's all black, and at 1 it's all default
         '''
         x = max(min(1-x, 1), 0)
-        delta = int(self.longest_span / 2 * x)
-        # print(' scale is', x, 'with delta', delta)
-        for i, old_range in enumerate(self.original_ranges):
-            self.ranges[i] = range(old_range.start-delta, old_range.stop+delta)
+        delta = min(int(self.longest_span / 2 * x), self.max_delta)
+        # built only when the delta changes, not every frame of a fade
+        if delta != self.delta:
+            self.delta = delta
+            self.mask = self.build_mask(delta)
 
     def __contains__(self, x):
-        for black_range in self.ranges:
-            if x in black_range:
-                return True
-        return False
+        return not self.mask[x]
 
 class Strip:
     def __init__(self, strip_prefs):
         length = strip_prefs['length']
-        pin = strip_prefs['pin']
-        frequency = strip_prefs['frequency']
-        dma = strip_prefs['dma']
-        invert = strip_prefs['invert']
-        brightness = strip_prefs['brightness']
-        pin_channel = strip_prefs['pin_channel']
-        self.blacks = Blacks(strip_prefs['black'])
-
-        self.real_strip = Adafruit_NeoPixel(length, pin, frequency, dma, invert, brightness, pin_channel)
+        self.length = length
+        self.blacks = Blacks(strip_prefs['black'], length)
+
+        backend = strip_prefs.get('backend', 'ws281x')
+        if backend not in BACKENDS:
+            raise ValueError(f'unknown strip backend `{backend}`')
+        self.real_strip, self.delay = BACKENDS[backend](self, strip_prefs)
         self.real_strip.begin()
 
         pixel_order = strip_prefs['pixel_order'].lower()
 
         self.shift = [1<<((2-pixel_order.index(x))*8) for x in 'rgb']
-        self.delay = self.calculate_delay(length, frequency)
         print('time between frames:', self.delay)
         print('maximum fps:', 1/self.delay)
         self.next_available = 0
+        self.timing = frame_timing.FrameTiming()
 
         self.fps_timer = time.time()
         self.fps_histogram = defaultdict(int)
@@ -85,6 +98,35 @@ class Strip:
             b * self.shift[2]
         )
 
+    def pack(self, image_data):
+        '''
+        converts an image slice (rows, pixels, rgb) to one packed color per pixel,
+        in this strip's pixel order, padded or trimmed to the length of the strip
+        '''
+        image_data = np.asarray(image_data, dtype=np.uint8)
+        packed = np.zeros((image_data.shape[0], self.length), dtype=np.uint32)
+        width = min(image_data.shape[1], self.length)
+        for channel, shift in enumerate(self.shift):
+            packed[:, :width] += image_data[:, :width, channel].astype(np.uint32) * shift
+        return packed
+
+    def set_row(self, packed_row):
+        '''
+        sets every pixel at once from a row produced by pack()
+        '''
+        self.write((packed_row * self.blacks.mask).tolist())
+
+    def write(self, values):
+        '''
+        sets every pixel from a list of packed colors, with the blacks already applied
+        '''
+        led_data = getattr(self.real_strip, '_led_data', None)
+        if led_data is not None:
+            led_data[0:self.length] = values
+        else:
+            for x, value in enumerate(values):
+                self.real_strip.setPixelColor(x, value)
+
     def __setitem__(self, x, rgb):
         if x in self.blacks: 
             rgb = 0
@@ -95,8 +137,7 @@ class Strip:
         self.real_strip.setPixelColor(x, value)
 
     def clear(self, show=False):
-        for x in range(self.real_strip.numPixels()):
-            self.real_strip.setPixelColor(x, 0)
+        self.set_row(np.zeros(self.length, dtype=np.uint32))
         if show:
             self.show()
 
@@ -104,8 +145,11 @@ class Strip:
         need_to_wait = self.next_available - time.time()
         if need_to_wait > 0:
             time.sleep(need_to_wait)
+        start = time.time()
         self.real_strip.show()
-        self.next_available = time.time() + self.delay
+        now = time.time()
+        self.next_available = now + self.delay
+        self.timing.show(max(need_to_wait, 0), now - start)
         # self.print_fps()
 
     def print_fps(self):
@@ -129,3 +173,208 @@ class Strip:
             val = self.fps_histogram[key]
             block = '|'*int((val / max_value)*100)
             print(f'{key:>3d} {val:>3d} {block}')
+
+class Group_Blacks:
+    '''
+    the blacks of every strip in a Strip_Group, as one mask across all of them
+    '''
+    def __init__(self, strips):
+        self.strips = strips
+        self.deltas = None
+        self.scale()
+
+    def scale(self, x=1):
+        for strip in self.strips:
+            strip.blacks.scale(x)
+        deltas = [strip.blacks.delta for strip in self.strips]
+        # while fading, the blacks only grow every few frames
+        if deltas != self.deltas:
+            self.deltas = deltas
+            self.mask = np.concatenate([strip.blacks.mask for strip in self.strips] or [np.ones(0, dtype=bool)])
+
+class Strip_Group:
+    '''
+    the strips on one remote, drawn from one row that runs across all of them in order and
+    shown together, as often as the slowest of them allows
+    '''
+    def __init__(self):
+        self.strips = {}
+        self.offsets = {}
+        self.length = 0
+        self.delay = 0
+        self.next_available = 0
+        self.timing = frame_timing.FrameTiming()
+        self.blacks = Group_Blacks([])
+
+    def add(self, strip_prefs):
+        '''
+        adds a strip after the others, or replaces the one with the same name where it was
+        '''
+        name = strip_prefs.get('name', 'strip')
+        if name in self.strips:
+            print(f'replacing strip {name}')
+        self.strips[name] = Strip(strip_prefs)
+        self.offsets = {}
+        self.length = 0
+        for name, strip in self.strips.items():
+            self.offsets[name] = self.length
+            self.length += strip.length
+        self.delay = max(strip.delay for strip in self.strips.values())
+        self.blacks = Group_Blacks(list(self.strips.values()))
+        # ws281x strips sharing a controller are all sent by one render
+        shown_by = (getattr(strip.real_strip, 'controller', strip.real_strip) for strip in self.strips.values())
+        self.renderers = list({id(renderer): renderer for renderer in shown_by}.values())
+
+    def columns(self, name):
+        '''
+        the slice of the group's rows that belongs to the named strip
+        '''
+        start = self.offsets[name]
+        return slice(start, start + self.strips[name].length)
+
+    def set_row(self, packed_row):
+        values = (packed_row * self.blacks.mask).tolist()
+        for name, strip in self.strips.items():
+            strip.write(values[self.columns(name)])
+
+    def clear(self, show=False):
+        self.set_row(np.zeros(self.length, dtype=np.uint32))
+        if show:
+            self.show()
+
+    def show(self):
+        need_to_wait = self.next_available - time.time()
+        if need_to_wait > 0:
+            time.sleep(need_to_wait)
+        start = time.time()
+        for renderer in self.renderers:
+            renderer.show()
+        now = time.time()
+        self.next_available = now + self.delay
+        self.timing.show(max(need_to_wait, 0), now - start)
+
+def ws281x_check(result, function):
+    if result != 0:
+        raise RuntimeError(f'{function} failed with code {result} ({ws.ws2811_get_return_t_str(result)})')
+
+class WS281x_Controller:
+    '''
+    one ws2811_t for each DMA channel, driving both of its PWM channels, so strips on two
+    pins of one Pi are sent together by a single render
+    '''
+    _controllers = {}
+
+    @classmethod
+    def get(cls, dma, frequency):
+        controller = cls._controllers.get(dma)
+        if controller is None:
+            controller = cls._controllers[dma] = cls(dma, frequency)
+        elif controller.frequency != frequency:
+            raise ValueError(f'strips on dma {dma} need the same frequency, not {controller.frequency} and {frequency}')
+        return controller
+
+    def __init__(self, dma, frequency):
+        if ws is None:
+            raise ImportError('rpi_ws281x not installed')
+        self.dma = dma
+        self.frequency = frequency
+        self.leds = ws.new_ws2811_t()
+        for number in range(2):
+            channel = ws.ws2811_channel_get(self.leds, number)
+            ws.ws2811_channel_t_count_set(channel, 0)
+            ws.ws2811_channel_t_gpionum_set(channel, 0)
+            ws.ws2811_channel_t_invert_set(channel, 0)
+            ws.ws2811_channel_t_brightness_set(channel, 0)
+        ws.ws2811_t_freq_set(self.leds, frequency)
+        ws.ws2811_t_dmanum_set(self.leds, dma)
+        self.owners = {}  # PWM channel: name of the strip on it
+        self.started = False
+        atexit.register(self.close)
+
+    def add(self, name, length, pin, invert, brightness, number):
+        owner = self.owners.get(number)
+        if owner is not None and owner != name:
+            raise ValueError(f'{name} and {owner} are both on pin_channel {number} of dma {self.dma}')
+        self.owners[number] = name
+        channel = ws.ws2811_channel_get(self.leds, number)
+        ws.ws2811_channel_t_gamma_set(channel, list(range(256)))
+        ws.ws2811_channel_t_count_set(channel, length)
+        ws.ws2811_channel_t_gpionum_set(channel, pin)
+        ws.ws2811_channel_t_invert_set(channel, 1 if invert else 0)
+        ws.ws2811_channel_t_brightness_set(channel, brightness)
+        ws.ws2811_channel_t_strip_type_set(channel, ws.WS2811_STRIP_GRB)
+        return WS281x_Channel(self, channel, length)
+
+    def begin(self):
+        # the buffers are sized for the channels when initialized, so a strip added later starts it again
+        if self.started:
+            ws.ws2811_fini(self.leds)
+        ws281x_check(ws.ws2811_init(self.leds), 'ws2811_init')
+        self.started = True
+
+    def show(self):
+        ws281x_check(ws.ws2811_render(self.leds), 'ws2811_render')
+
+    def close(self):
+        if self.started:
+            ws.ws2811_fini(self.leds)
+            self.started = False
+
+class WS281x_Channel:
+    '''
+    one strip of a WS281x_Controller, standing in for Adafruit_NeoPixel. show() sends every
+    strip of the controller
+    '''
+    def __init__(self, controller, channel, length):
+        self.controller = controller
+        self.channel = channel
+        self.length = length
+        self._led_data = self  # so Strip.write sets a whole row by slice
+
+    def __setitem__(self, pos, value):
+        if isinstance(pos, slice):
+            for n, color in zip(range(*pos.indices(self.length)), value):
+                ws.ws2811_led_set(self.channel, n, color)
+        else:
+            ws.ws2811_led_set(self.channel, pos, value)
+
+    def setPixelColor(self, n, color):
+        ws.ws2811_led_set(self.channel, n, color)
+
+    def begin(self):
+        self.controller.begin()
+
+    def show(self):
+        self.controller.show()
+
+def ws281x_backend(strip, strip_prefs):
+    length = strip_prefs['length']
+    frequency = strip_prefs['frequency']
+    controller = WS281x_Controller.get(strip_prefs['dma'], frequency)
+    real_strip = controller.add(strip_prefs.get('name', 'strip'), length, strip_prefs['pin'], strip_prefs['invert'],
+                                strip_prefs['brightness'], strip_prefs['pin_channel'])
+    return real_strip, strip.calculate_delay(length, frequency)
+
+def udp_backend(strip, strip_prefs):
+    from . import udp_strip
+    real_strip = udp_strip.UDP_Strip(strip_prefs['length'], strip_prefs['nodes'], strip_prefs.get('packet_gap', 0))
+    # the nodes show their pixels at the same time, so only the longest one counts
+    delay = strip.calculate_delay(real_strip.longest_node, strip_prefs['frequency']) + real_strip.overhead
+    return real_strip, delay
+
+def recording_backend(strip, strip_prefs):
+    from . import recording_strip
+    delay = strip.calculate_delay(strip_prefs['length'], strip_prefs['frequency'])
+    real_strip = recording_strip.Recording_Strip(strip_prefs['length'], delay,
+                                                 strip_prefs.get('frames', recording_strip.FRAMES),
+                                                 strip_prefs.get('simulate', True))
+    return real_strip, delay
+
+# each backend takes the Strip and its prefs, and returns the strip to draw on and the
+# time between frames. the strip needs begin(), show(), setPixelColor(n, color) and,
+# to set whole rows at once, a _led_data sequence with a color per pixel
+BACKENDS = {
+    'ws281x': ws281x_backend,
+    'udp': udp_backend,
+    'recording': recording_backend,
+}
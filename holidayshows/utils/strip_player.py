@@ -1,16 +1,57 @@
-from collections import defaultdict
+from collections import defaultdict, deque
 from datetime import datetime
-from random import uniform
+import os
 import time
 
-from ..utils import strip, image_slicer
+import numpy as np
+
+from ..utils import strip, image_slicer, live_stream, relay, row_stream
+
+TIMING_SUMMARIES = 20  # frame timing is kept for this many of the latest songs
 
 class Strip_Player():
+    '''
+    plays every strip on this remote, as one strip.Strip_Group on one frame clock
+    '''
     def __init__(self, config):
-        self.strip = strip.Strip(config)
+        self.strip = strip.Strip_Group()
+        self.strip.add(config)
+        if config.get('image_cache'):
+            image_slicer.ImageSlicer().configure(**config['image_cache'])
+        self.streaming = bool(config.get('streaming'))
+        self.stream_parent = config.get('stream_directory')
+        self.stream_directory = None
+        if self.streaming:
+            row_stream.remove_stale_directories(self.stream_parent)
         self.image_data = {}
         self.relay_data = defaultdict(lambda: None)
+        self.relay_timelines = {}
         self.relays = {}
+        self.timing_summaries = deque(maxlen=TIMING_SUMMARIES)
+        self.live_port = config.get('live_port') or live_stream.LIVE_PORT
+        self.live = None
+
+    @property
+    def name(self):
+        return '+'.join(self.strip.strips)
+
+    def add_strip(self, config):
+        '''
+        another strip on the same remote. songs already loaded no longer fit, so they are dropped
+        '''
+        for index in list(self.image_data):
+            self.release(index)
+        self.strip.add(config)
+        self.live = None
+
+    def strip_name(self, name):
+        if name is None:
+            if len(self.strip.strips) > 1:
+                raise ValueError(f'say which strip of {self.name} the data is for')
+            return next(iter(self.strip.strips))
+        if name not in self.strip.strips:
+            raise ValueError(f'no strip named `{name}`, only {self.name}')
+        return name
 
     def load_data(self, arguments):
         index = arguments['index']
@@ -22,21 +63,77 @@ class Strip_Player():
             self.load_relays(index, arguments['procedural_relays'], arguments['relay_order'], arguments['home'])
 
         elif 'image_data' in arguments:
-            self.load_image(index, arguments['image_data'])
+            self.load_image(index, arguments['image_data'], self.strip_name(arguments.get('strip')))
         elif 'slice_data' in arguments:
-            self.slice_image(index, arguments['slice_data'])
+            self.slice_image(index, arguments['slice_data'], self.strip_name(arguments.get('strip')))
 
         else:
             raise ValueError(f'unexpected arguments {list(arguments)}')
 
-    def load_image(self, index, image_data):
-        self.image_data[index] = image_data
+    def load_image(self, index, image_data, name):
+        self.release(index, name)
+        self.place(index, name, self.strip.strips[name].pack(image_data))
 
-    def slice_image(self, index, slice_data):
+    def slice_image(self, index, slice_data, name):
         path, start, end, wrap = slice_data
-        print('slicing image', path, 'from', start, 'to', end, 'wrap', wrap)
-        sliced = image_slicer.ImageSlicer().slice_image(path, start, end, wrap)
-        self.image_data[index] = sliced
+        print('slicing image', path, 'from', start, 'to', end, 'wrap', wrap, 'for', name)
+        self.release(index, name)
+        slicer = image_slicer.ImageSlicer()
+        if self.streaming:
+            self.place(index, name, self.stream_slice(index, name, slicer, path, start, end, wrap))
+            return
+        sliced = slicer.slice_image(path, start, end, wrap)
+        self.place(index, name, self.strip.strips[name].pack(sliced))
+        print('image cache:', slicer.cache)
+
+    def stream_slice(self, index, name, slicer, path, start, end, wrap):
+        '''
+        packs the slice into a file a block at a time, to be memory mapped during play
+        '''
+        if self.stream_directory is None:
+            self.stream_directory = row_stream.make_directory(self.stream_parent)
+        strip = self.strip.strips[name]
+        blocks = (strip.pack(block) for block in slicer.iter_slice(path, start, end, wrap, row_stream.BLOCK_ROWS))
+        rows_path = os.path.join(self.stream_directory, f'{index}-{list(self.strip.strips).index(name)}.rows')
+        return row_stream.Row_Stream.write(rows_path, strip.length, blocks)
+
+    def place(self, index, name, rows):
+        '''
+        puts one strip's packed rows for a song alongside the other strips' rows, so each
+        frame is one row across the whole group
+        '''
+        if len(self.strip.strips) == 1:
+            self.image_data[index] = rows
+            return
+        combined = self.image_data.get(index)
+        if combined is not None and len(combined) and len(combined) != len(rows):
+            print(f'{name} has {len(rows)} rows for song {index} where the other strips have {len(combined)}, so theirs are dropped')
+            self.release(index)
+            combined = None
+        if isinstance(rows, row_stream.Row_Stream):
+            if not isinstance(combined, row_stream.Side_By_Side):
+                self.release(index)
+                combined = row_stream.Side_By_Side(self.strip)
+            combined.add(name, rows)
+        else:
+            if not isinstance(combined, np.ndarray):
+                self.release(index)
+                combined = np.zeros((len(rows), self.strip.length), dtype=np.uint32)
+            combined[:, self.strip.columns(name)] = rows
+        self.image_data[index] = combined
+
+    def release(self, index, name=None):
+        '''
+        drops a song's rows, or with more than one strip, only the named strip's streamed rows
+        '''
+        image_data = self.image_data.get(index)
+        if name is not None and len(self.strip.strips) > 1:
+            if isinstance(image_data, row_stream.Side_By_Side):
+                image_data.remove(name)
+            return
+        self.image_data.pop(index, None)
+        if isinstance(image_data, (row_stream.Row_Stream, row_stream.Side_By_Side)):
+            image_data.close()
 
     def slice_relays(self, index, slice_data, relay_order, home):
         path, start, end = slice_data
@@ -44,24 +141,40 @@ class Strip_Player():
         self.load_relays(index, sliced, relay_order, home)
 
     def load_relays(self, index, relay_data, relay_order, home):
+        if isinstance(relay_data, dict):
+            # procedural
+            self.relay_timelines.pop(index, None)
+        else:
+            relay_data = np.asarray(relay_data, dtype=bool)
+            self.relay_timelines[index] = relay.compile_timeline(relay_data, relay_order, home.relays)
         self.relay_data[index] = relay_data
         self.relays[index] = relay_order
         self.home = home  # this is a hack, but relays are a hack right now anyway
 
     def play(self, arguments):
+        if arguments.get('live'):
+            yield from self.play_live(arguments)
+            return
         index = arguments['index']
         repeat = arguments['repeat']
         end_by = arguments['end_by']
         epoch = arguments['epoch']
         fps = arguments['fps']
+        clock = arguments.get('clock', time.time)
 
         image_data = self.image_data[index]
         relay_data = self.relay_data[index]
+        timeline = self.relay_timelines.get(index)
         if relay_data is not None:
             relays = self.relays[index]
-            if 'mode' in relay_data and relay_data['mode'] == 'random':
-                # sure is ugly copying this logic twice...
-                relay_toggle_time = {name: uniform(0, 1.5)*(fps * relay_data['timing'] * (1-relay_data['duty_cycle'])) for name in relays}
+            if timeline is not None:
+                # relays not in the timeline keep the state they have now
+                bases = {remote.name: remote.bits() & ~mask for remote, mask, states in timeline}
+                for name in relays:
+                    self.home.relays[name].set(False)  # on time is credited from the timeline afterwards
+            else:
+                for name in relays:
+                    self.home.relays[name].set(False)  # the events start from everything off
 
         height = len(image_data)
         print('\n')
@@ -74,12 +187,17 @@ class Strip_Player():
         FADE_IN_SECONDS = 30
         FADE_OUT_SECONDS = 60
         abs_y = 0
-        now = time.time()
+        now = clock()
         while epoch and epoch > now:
-            time.sleep(0.001)
-            yield 'waiting for start time'
-            now = time.time()
+            yield epoch
+            now = clock()
         self.strip.blacks.scale()
+        self.strip.timing.start(index, fps)
+        skipped = 0
+        relay_events = None
+        last_relay_show = 0
+        if relay_data is not None and timeline is None:
+            relay_events = relay.RelayEvents(self.procedural_events(relay_data, relays, epoch, end_by, FADE_IN_SECONDS, FADE_OUT_SECONDS))
         try:
             while (repeat and (abs_y < height * repeat)) or (not repeat and now < end_by):
                 y = abs_y % height
@@ -90,56 +208,123 @@ class Strip_Player():
                 if repeat == 0:
                     self.strip.blacks.scale(fade)
 
-                if relay_data is not None:
-                    if 'mode' in relay_data:
-                        if relay_data['mode'] == 'cycle':
-                            for i, name in enumerate(relays):
-                                if i / len(relays) > fade:
-                                    on = False
-                                else:
-                                    on = (abs_y // (fps * relay_data[1])) % len(relays) != i
-                                self.home.relays[name].set(on)
-                                if on:
-                                    print(name.upper(), end=' ')
-                                else:
-                                    print(name.lower(), end=' ')
-                            print()
-                        elif relay_data['mode'] == 'random':
-                            for name in relays:
-                                if abs_y > relay_toggle_time[name]:
-                                    if self.home.relays[name].value:
-                                        relay_toggle_time[name] = abs_y + uniform(0.5, 1.5) * (fps * relay_data['timing'] * (1-relay_data['duty_cycle']))
-                                        self.home.relays[name].set(False)
-                                    else:
-                                        relay_toggle_time[name] = abs_y + uniform(0.5, 1.5) * (fps * relay_data['timing'] * relay_data['duty_cycle'])
-                                        if relay_toggle_time[name] > end_by:  # will turn off AFTER the end, so not enough time to turn on
-                                            print(name, 'staying off')
-                                        else:
-                                            self.home.relays[name].set(True)
-                        else:
-                            raise NotImplementedError()
-                    else:
-                        relay_row = relay_data[y]
-                        for x, name in enumerate(relays):
-                            self.home.relays[name].set(relay_row[x])
-                    self.home.show_relays()
-
-                image_row = image_data[y]
-                for x, color in enumerate(image_row):
-                    self.strip[x] = color.tolist()
+                if timeline is not None:
+                    for remote, mask, states in timeline:
+                        remote.send_state(bases[remote.name] | int(states[y]))
+                elif relay_events is not None:
+                    changed = False
+                    for when, name, on in relay_events.due(now):
+                        self.home.relays[name].set(on)
+                        changed = True
+                    if changed or now - last_relay_show >= relay.KEEPALIVE_SECONDS:
+                        self.home.show_relays()
+                        last_relay_show = now
 
+                self.strip.timing.frame(now - (epoch + abs_y / fps), skipped)
+                self.strip.set_row(image_data[y])
                 self.strip.show()
 
                 while True:
-                    yield f'play in progress: {y / height:.0%}'
-                    now = time.time()
+                    yield epoch + (abs_y + 1) / fps  # when the next row is due
+                    now = clock()
                     previous_y = abs_y
                     abs_y = int((now - epoch) * fps)
                     if abs_y != previous_y:
+                        skipped = abs_y - previous_y - 1
                         break
         finally:
+            self.timing_summaries.append(self.strip.timing.summary())
+            self.strip.timing.report()
+            if timeline is not None:
+                played = min(abs_y, height * repeat) if repeat else abs_y
+                self.credit_relays(relay_data, relays, played, fps)
             self.cleanup()
 
+    def play_live(self, arguments):
+        '''
+        shows rows streamed from a live_stream.Live_Sender, each at its own time, until end_by
+        '''
+        end_by = arguments['end_by']
+        clock = arguments.get('clock', time.time)
+        if self.live is None:
+            receiver = live_stream.Live_Receiver.get(self.live_port)
+            self.live = {name: receiver.register(name, strip.pack) for name, strip in self.strip.strips.items()}
+        print(f'playing live rows until {datetime.fromtimestamp(end_by)}')
+        now = clock()
+        for buffer in self.live.values():
+            buffer.discard_before(now)
+        self.strip.blacks.scale()
+        self.strip.timing.start(None, arguments.get('fps'))
+        # each strip keeps its latest row until another one is due
+        live_row = np.zeros(self.strip.length, dtype=np.uint32)
+        try:
+            while now < end_by:
+                earliest = None
+                most_skipped = 0
+                for name, buffer in self.live.items():
+                    due = buffer.due(now)
+                    if due is not None:
+                        show_at, row, skipped = due
+                        live_row[self.strip.columns(name)] = row
+                        earliest = show_at if earliest is None else min(earliest, show_at)
+                        most_skipped = max(most_skipped, skipped)
+                if earliest is not None:
+                    self.strip.timing.frame(now - earliest, most_skipped)
+                    self.strip.set_row(live_row)
+                    self.strip.show()
+                next_times = [buffer.next_time() for buffer in self.live.values()]
+                next_time = min((when for when in next_times if when is not None), default=None)
+                if next_time is None or next_time > now + live_stream.POLL_SECONDS:
+                    next_time = now + live_stream.POLL_SECONDS  # in case an earlier row arrives meanwhile
+                yield min(next_time, end_by)
+                now = clock()
+        finally:
+            self.timing_summaries.append(self.strip.timing.summary())
+            self.strip.timing.report()
+            for name, buffer in self.live.items():
+                print(f'{name} live buffer:', buffer)
+            self.cleanup()
+
+    @staticmethod
+    def procedural_events(relay_data, relays, epoch, end_by, fade_in, fade_out):
+        if relay_data['mode'] == 'cycle':
+            return relay.cycle_events(relays, relay_data['timing'], epoch, end_by, fade_in, fade_out)
+        elif relay_data['mode'] == 'random':
+            return relay.random_events(relays, relay_data['timing'], relay_data['duty_cycle'], epoch, end_by)
+        else:
+            raise NotImplementedError()
+
+    def loaded(self):
+        return sorted(set(self.image_data) | set(self.relays))
+
+    def unload(self, index):
+        self.release(index)
+        self.relay_data.pop(index, None)
+        self.relay_timelines.pop(index, None)
+        self.relays.pop(index, None)
+
+    def frame_timing(self):
+        '''
+        summaries of the latest songs, oldest first
+        '''
+        return list(self.timing_summaries)
+
+    def metrics(self):
+        return self.strip.timing.metrics(strip=self.name)
+
+    def credit_relays(self, relay_rows, relays, played, fps):
+        '''
+        works out how long each timeline relay was on from the rows played,
+        and leaves it in the state of the last row
+        '''
+        height = len(relay_rows)
+        cycles, remainder = divmod(played, height)
+        on_frames = relay_rows.sum(axis=0) * cycles + relay_rows[:remainder].sum(axis=0)
+        last_row = relay_rows[(played - 1) % height] if played else np.zeros(len(relays), dtype=bool)
+        for x, name in enumerate(relays):
+            self.home.relays[name].credit_on_time(on_frames[x] / fps)
+            self.home.relays[name].set(last_row[x])
+
     def cleanup(self):
         self.strip.blacks.scale()
 
@@ -153,3 +338,10 @@ class Strip_Player():
 
     def stop(self):
         self.strip.clear(True)
+        for index in list(self.image_data):
+            self.release(index)
+        if self.stream_directory is not None:
+            os.rmdir(self.stream_directory)
+            self.stream_directory = None
+        if self.streaming:
+            row_stream.remove_stale_directories(self.stream_parent)
@@ -0,0 +1,245 @@
+#! /usr/bin/env python3
+'''
+pixel strips on the other end of a network, driven by the UDPPixelStreamer sketch
+
+the sketch shows a packet of exactly NUM_LEDS*3 bytes (r, g, b for each pixel) as a
+frame, answers AA0000 with BB0000, and CC0000 with the frames shown since it was last asked.
+one strip can be split across several nodes, each taking the next `pixels` pixels.
+
+strips longer than fit in one packet can use chunked framing instead, where each packet
+carries FRAGMENT followed by the bytes for `count` pixels starting at `offset`. the node
+shows the frame once every pixel of it has arrived. the sketch's FRAGMENT_PIXELS has to
+match MAX_PAYLOAD // 3. to test without a node, the stand-in receiver:
+
+    python3 -m holidayshows.utils.udp_strip [port] [pixels]
+
+listens like a node would, and prints what arrives once a second
+'''
+
+import socket
+import struct
+import sys
+import time
+
+import numpy as np
+
+PORT = 2700
+FIRMWARE_LOOP_SECONDS = 0.01  # the sketch waits this long between packets
+MAX_PAYLOAD = 1440  # bytes of pixels in one packet, to stay under a 1500 byte MTU
+# 0xDF, frame number, first pixel, pixel count
+FRAGMENT = struct.Struct('!BHHH')
+
+class UDPStripException(Exception):
+    pass
+
+class Node(object):
+    def __init__(self, config, first):
+        self.host = config['host']
+        self.port = config.get('port', PORT)
+        self.pixels = config['pixels']
+        self.framing = config.get('framing', 'raw')
+        self.first = first
+        self.stop = first + self.pixels
+        self.frames = 0
+        if self.framing == 'raw':
+            if self.pixels * 3 > MAX_PAYLOAD:
+                raise UDPStripException(f'{self.pixels} pixels for {self.host} do not fit in one packet. use "framing": "chunked"')
+            self.packets = 1
+        elif self.framing == 'chunked':
+            self.per_packet = MAX_PAYLOAD // 3
+            self.packets = -(-self.pixels // self.per_packet)
+        else:
+            raise UDPStripException(f'unknown framing `{self.framing}`')
+
+    def __str__(self):
+        return f'{self.host}:{self.port} (pixels {self.first}-{self.stop}, {self.framing})'
+
+    def payloads(self, pixel_bytes):
+        '''
+        pixel_bytes is (pixels, 3) for this node's pixels
+        '''
+        if self.framing == 'raw':
+            yield pixel_bytes.tobytes()
+            return
+        frame = self.frames & 0xFFFF
+        for offset in range(0, self.pixels, self.per_packet):
+            count = min(self.per_packet, self.pixels - offset)
+            yield FRAGMENT.pack(0xDF, frame, offset, count) + pixel_bytes[offset:offset + count].tobytes()
+
+class UDP_Strip(object):
+    '''
+    stands in for Adafruit_NeoPixel, sending the strip to its nodes on show()
+
+    colors are packed as usual, so the strip's pixel_order decides the byte order
+    on the wire. the sketch expects "RGB"
+    '''
+    def __init__(self, length, nodes, packet_gap=0):
+        self.length = length
+        self.packet_gap = packet_gap  # seconds between packets, for nodes with small receive buffers
+        self.nodes = []
+        first = 0
+        for config in nodes:
+            node = Node(config, first)
+            first = node.stop
+            self.nodes.append(node)
+        if first > length:
+            raise UDPStripException(f'nodes have {first} pixels, but the strip only has {length}')
+        self._led_data = np.zeros(length, dtype=np.uint32)
+        self.socket = None
+
+    @property
+    def longest_node(self):
+        return max((node.pixels for node in self.nodes), default=0)
+
+    @property
+    def overhead(self):
+        '''
+        seconds spent per frame beyond showing the pixels, which the nodes do in parallel
+        '''
+        packets = sum(node.packets for node in self.nodes)
+        return FIRMWARE_LOOP_SECONDS + self.packet_gap * max(packets - 1, 0)
+
+    def begin(self):
+        self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        for node in self.nodes:
+            self.handshake(node)
+        self.get_frames()  # to zero them out on the nodes
+
+    def handshake(self, node):
+        self.socket.settimeout(1)
+        self.socket.sendto(bytes.fromhex('AA0000'), (node.host, node.port))
+        try:
+            message, (returnIP, returnPort) = self.socket.recvfrom(64)
+        except socket.timeout:
+            raise UDPStripException(f'Timeout on handshake with {node}') from None
+        if message[:1] != b'\xBB':
+            raise UDPStripException(f'Invalid handshake message: {message}')
+        print(f'{returnIP} replied to handshake request to {node}')
+        node.host = returnIP
+
+    def get_frames(self):
+        '''
+        frames shown by each node since last asked, and frames sent to it. None if it didn't answer
+        '''
+        results = {}
+        self.socket.settimeout(1)
+        for node in self.nodes:
+            self.socket.sendto(bytes.fromhex('CC0000'), (node.host, node.port))
+            try:
+                message, _ = self.socket.recvfrom(64)
+                received = int.from_bytes(message[1:3], 'big') if message[:1] == b'\xCC' else None
+            except socket.timeout:
+                received = None
+            results[str(node)] = (received, node.frames)
+            node.frames = 0
+        return results
+
+    def numPixels(self):
+        return self.length
+
+    def setPixelColor(self, n, color):
+        self._led_data[n] = color
+
+    def getPixelColor(self, n):
+        return int(self._led_data[n])
+
+    def show(self):
+        # big endian puts the first color of the pixel order right after the unused byte
+        pixel_bytes = self._led_data.astype('>u4').view(np.uint8).reshape(self.length, 4)[:, 1:]
+        first_packet = True
+        for node in self.nodes:
+            for payload in node.payloads(pixel_bytes[node.first:node.stop]):
+                if self.packet_gap and not first_packet:
+                    time.sleep(self.packet_gap)
+                first_packet = False
+                try:
+                    self.socket.sendto(payload, (node.host, node.port))
+                except OSError as e:
+                    print(f'error sending to {node}: {e}')
+            node.frames += 1
+
+class Receiver(object):
+    '''
+    answers like a UDPPixelStreamer node, for testing without one
+    '''
+    def __init__(self, port=PORT, pixels=60):
+        self.pixels = pixels
+        self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.socket.bind(('', port))
+        print(f'receiving {pixels} pixels on port {port}')
+        self.counter = 0
+        self.frame = None
+        self.arrived = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.shown = 0
+        self.incomplete = 0
+        self.unexpected = 0
+        self.stats_time = time.time()
+
+    def listen_forever(self):
+        self.socket.settimeout(1)
+        while True:
+            try:
+                message, address = self.socket.recvfrom(65536)
+            except socket.timeout:
+                message = None
+            if message is not None:
+                reply = self.handle(message)
+                if reply is not None:
+                    self.socket.sendto(reply, address)
+            if time.time() - self.stats_time >= 1:
+                self.print_stats()
+
+    def handle(self, message):
+        if len(message) == 3:
+            if message[0] == 0xAA:
+                return bytes.fromhex('BB0000')
+            if message[0] == 0xCC:
+                reply = bytes([0xCC]) + self.counter.to_bytes(2, 'big')
+                self.counter = 0
+                return reply
+        elif len(message) == self.pixels * 3:
+            self.show(message)
+        elif len(message) > FRAGMENT.size and message[0] == 0xDF:
+            self.fragment(message)
+        else:
+            self.unexpected += 1
+
+    def fragment(self, message):
+        _, frame, offset, count = FRAGMENT.unpack_from(message)
+        if frame != self.frame:
+            if self.arrived:
+                self.incomplete += 1
+            self.frame = frame
+            self.arrived = {}
+            self.buffer = bytearray(self.pixels * 3)
+        if offset + count > self.pixels or len(message) != FRAGMENT.size + count * 3:
+            self.unexpected += 1
+            return
+        self.buffer[offset * 3:(offset + count) * 3] = message[FRAGMENT.size:]
+        self.arrived[offset] = count
+        if sum(self.arrived.values()) >= self.pixels:
+            self.show(bytes(self.buffer))
+            self.arrived = {}
+
+    def show(self, pixel_bytes):
+        self.counter = (self.counter + 1) & 0xFFFF
+        self.shown += 1
+        self.last = pixel_bytes
+
+    def print_stats(self):
+        elapsed = time.time() - self.stats_time
+        if self.shown or self.incomplete or self.unexpected:
+            first = self.last[:3].hex() if self.shown else '-'
+            print(f'{self.shown / elapsed:.1f} fps, {self.incomplete} incomplete frames, {self.unexpected} unexpected packets, first pixel {first}')
+        self.reset_stats()
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+    pixels = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    try:
+        Receiver(port, pixels).listen_forever()
+    except KeyboardInterrupt:
+        pass